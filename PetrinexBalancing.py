@@ -19,16 +19,27 @@ change include:
 """
 
 import pandas as pd
-import seaborn as sns
-import matplotlib.pyplot as plt
 import datetime as dt
 import numpy as np
-
-
-def readData(DataCSV, ACodesCSV):
-    # read in the two csv files
-    plantData = pd.read_csv(DataCSV)
-    plant_AC = pd.read_csv(ACodesCSV)
+import contextlib
+import io
+from functools import partial
+from petrinex.rules import readExclusionRules, limitPasses
+from petrinex.rebalance import rebalance, balanceLimit
+from petrinex.volume import parseVolume, reportVolume
+from petrinex.memory import compactFrame, fillMissing, memoryUsage
+from petrinex.output import ResultSink, outputFileName
+from petrinex.profiling import RunLog
+from petrinex.files import csvSource
+from petrinex.factors import readActivityFactors, attachFactors
+from petrinex.breakdown import BreakdownBuilder, exportRows, exportBreakdown
+from petrinex.shards import runShards, readShard, writeShard, reportUnbalanced
+
+
+def readData(DataCSV, activityFactors, compact=False):
+    # read in the csv file, activityFactors is the table readActivityFactors read at the start of the run
+    with csvSource(DataCSV) as source:
+        plantData = pd.read_csv(source)
     print("Data has been read\n")
     
     # drop the variables that we aren't interested in
@@ -37,8 +48,18 @@ def readData(DataCSV, ACodesCSV):
                                           'FacilityRange', 'FacilityMeridian','FromToIDProvinceState', 'FromToIDType', 'FromToIDIdentifier',
                                           'Hours', 'ProrationProduct', 'ProrationFactor', 'Heat'])
     
-    # merge the two dataframes
-    plantData = pd.merge(plantData, plant_AC, on= 'ActivityID')
+    # convert volume to float as the data comes in, masked and blank volumes become 0
+    volume, masked, unparseable = parseVolume(plantData["Volume"])
+    plantData["Volume"] = volume
+    reportVolume(masked, unparseable)
+    print("Volume data has been converted to float\n")
+    
+    # in compact mode the identifier columns become categoricals, see petrinex/memory.py
+    if compact:
+        plantData = compactFrame(plantData)
+    
+    # attach each row's factor, rows with an activity that isn't in the table are left out, see petrinex/factors.py
+    plantData = attachFactors(plantData, activityFactors)
     print("Data has been merged\n")
     
     return plantData
@@ -49,20 +70,9 @@ def preprocessColumns(plantData):
     #clean and format the data#
     ###########################
     
-    # fixing errors in the volume data
-    # Relace the commas with empty string
-    plantData['Volume'] = plantData['Volume'].str.replace(',','')
-
-    # Replace the *** with empty string
-    plantData['Volume'] = plantData['Volume'].replace(to_replace='\*\*\*', value='0', regex=True)
-
-    # Replace NaN with 0 for Volume
-    #plantData['Volume'] = plantData['Volume'].fillna(0)
-    plantData = plantData.fillna(0)
-    
-    # converted volume to float to be able to balance out the volumes via activity
-    plantData["Volume"] = pd.to_numeric(plantData["Volume"])
-    print("Volume data has been converted to float\n")
+    # volume was already converted to float in readData, see petrinex/volume.py
+    # Replace NaN with 0
+    plantData = fillMissing(plantData, 0)
     
 
     
@@ -87,102 +97,152 @@ def balanceData(plantData):
     # create a new column that is the volume multiplied by the factor
     plantData["Balance"] = plantData["Volume"]*plantData["Factor"]
     
-    #for i in range(counter - 1):
-    #    plantData = plantData[plantData['NullCombinations' + str(i)] != 0]
+    # give every ReportingFacilityID a number and sum up the balance values for each plant ID in one pass
+    facilityCodes, facilityIDs = pd.factorize(plantData["ReportingFacilityID"])
+    sums = plantData["Balance"].groupby(facilityCodes).sum().reindex(range(len(facilityIDs))).to_numpy()
     
-    # now we can get all the unique ReportingFacilityID and sum up the balance values
-    plantIDs = plantData[["ReportingFacilityID", "Balance"]].copy()
-    
-    # now we can join and transform each plant ID and sum up the balance values
-    plantIDs = plantIDs.join(plantIDs.groupby("ReportingFacilityID").transform(sum).add_prefix('sum'))
-    
-    # drop duplicates to get final list of balanced plant ids
-    plantIDs = plantIDs.drop(columns=['Balance']).drop_duplicates()
+    # look up each row's sum by its plant number, rows with no plant ID get code -1 which picks up the NaN on the end
+    sumBalance = np.append(sums, np.nan)[facilityCodes]
     
     # run a check to see if the sum of the balance values is 0 for each plant ID
-    doesNotEqualZero = plantIDs[(plantIDs['sumBalance'] > 0.05) | (plantIDs['sumBalance'] < -0.05)]
+    doesNotEqualZero = pd.DataFrame({"ReportingFacilityID": facilityIDs, "sumBalance": sums})
+    doesNotEqualZero = doesNotEqualZero[(doesNotEqualZero['sumBalance'] > balanceLimit) | (doesNotEqualZero['sumBalance'] < -balanceLimit)]
     Count = len(doesNotEqualZero['ReportingFacilityID'])
     doesNotEqualZero = doesNotEqualZero.sort_values(by=['sumBalance'])
     print("There are " + str(Count) + " plants that have not been properly balanced:\n")
     print(doesNotEqualZero)
     
-    # merge the unbalanced plant data with the balanced plant data
-    plantData = pd.merge(plantData, doesNotEqualZero, on= 'ReportingFacilityID')
+    # keep only the rows for the unbalanced plants and attach their sums
+    unbalanced = (sumBalance > balanceLimit) | (sumBalance < -balanceLimit)
+    plantData = plantData[unbalanced].reset_index(drop=True)
+    plantData["sumBalance"] = sumBalance[unbalanced]
     
     return plantData
 
 
-def rebalanceData(plantData):
-    ######################################################################
-    # drop the rows where the activity is FLARE and the product is ENTGAS#
-    ######################################################################
-    
-    # maybe throw a hash map here and then we can group everything in pairs and have it loop through each pair
-    ############ iterate through each activity and product pair and create a new column that is 0 if the activity and product match the pair and 1 if they don't
-    activityList = ['FLARE']
-    productList = ['ENTGAS']
-    activityID = plantData['ActivityID']
-    productID = plantData['ProductID']
-    counter = 0
-    
-    # loop through each activity and product pair
-    for (activity, product) in zip(activityList, productList):
-        # List conditions
-        conditions = [
-            # conditions for combination 'activity * product'
-            (activityID == activity) & (productID == product), # condition 1
-            # other conditions
-            (activityID != activity) & (productID != product), # condition 2
-            (activityID == activity) & (productID != product), # condition 3
-            (activityID != activity) & (productID == product) # condition 4
-        ]
-        # List of values to return
-        choices = [
-            0, # if condition 1 is true
-            1, # if condition 2 is true
-            1, # if condition 3 is true
-            1 # if condition 4 is true
-        ]
-        # create a new column and use np.select to assign values to it using our lists as arguments
-        header = 'NullCombination' + str(counter)
-        plantData[header] = np.select(conditions, choices, default=0)
-        print("\n" + header + " has been created\n")
-        counter += 1
-        
-    # remove the rows where null combination is 0
-    for i in range(counter):
-        header = 'NullCombination' + str(i)
-        plantData = plantData[plantData[header] != 0]
-    # drop Balance and sumBalance columns to rebalance
-    plantData = plantData.drop(columns=['Balance', 'sumBalance'])
-    
-    return plantData
+def balanceShard(shardFile, exclusionRules, keepControl=True):
+    # runs in a worker process on one shard of the month's facilities, see petrinex/shards.py
+    # returns the files with the balanceData rows (when keepControl is set) and the rebalanced rows
+    plantData = readShard(shardFile)
+    with contextlib.redirect_stdout(io.StringIO()):
+        plantDataB = balanceData(preprocessColumns(plantData))
+        controlFile = writeShard(plantDataB, shardFile + ".control") if keepControl else None
+        plantDataB = rebalance(plantDataB, exclusionRules)
+    return controlFile, writeShard(plantDataB, shardFile + ".result")
 
 
-def exportData(plantData):
+def exportData(plantData, outputFormat="csv", export="rows"):
     #export to csv 
     # we export all Plant Data for plants that haven't been properly balanced
+    # and/or their breakdown by activity and product, see petrinex/breakdown.py
     month = dt.datetime.now().month
     year = dt.datetime.now().year
     date = str(month) + str(year)
-    plantData.to_csv('plantDataUnbalanced' + date + '.csv', index=False)
-    print("\nThe Unbalanced Plant Data has been exported to CSV\n")
-    print("Check in the folder for the file named plantDataUnbalanced" + date + ".csv\n")
+    if exportBreakdown(export):
+        breakdown = BreakdownBuilder()
+        breakdown.add(plantData)
+        breakdown.write(outputFileName('plantDataBreakdown' + date, outputFormat), outputFormat)
+    if not exportRows(export):
+        return
+    if outputFormat == "csv":
+        plantData.to_csv('plantDataUnbalanced' + date + '.csv', index=False)
+        print("\nThe Unbalanced Plant Data has been exported to CSV\n")
+        print("Check in the folder for the file named plantDataUnbalanced" + date + ".csv\n")
+    else:
+        sink = ResultSink(outputFileName('plantDataUnbalanced' + date, outputFormat), outputFormat)
+        sink.write(plantData)
+        sink.close()
     return
 
+def run(plantDataCSV, activityCodesCSV="activityCodeFactors.csv", exclusionRulesCSV="exclusionRules.csv",
+        outputFormat="csv", compactMemory=False, reportMemory=False, profileRun=False, export="rows", maxPasses=None,
+        workers=1):
+    # balances one file from start to finish, main and the command line (petrinex/cli.py) both call this
+    # export is rows, breakdown or both, see petrinex/breakdown.py
+    # maxPasses stops the rebalance after that many exclusion passes, see petrinex/rebalance.py
+    # with more than one worker the facilities are balanced in shards in worker processes, see petrinex/shards.py
+    exclusionRules = limitPasses(readExclusionRules(exclusionRulesCSV), maxPasses)
+    activityFactors = readActivityFactors(activityCodesCSV)
+    runLog = RunLog(profileRun)
+    
+    with runLog.stage("readData") as record:
+        plantData = readData(plantDataCSV, activityFactors, compactMemory)
+        record["rowsOut"] = len(plantData)
+    if reportMemory:
+        memoryUsage(plantData, "readData")
+    if workers > 1:
+        plantDataB = runShardedStages(plantData, exclusionRules, workers, runLog, reportMemory, export)
+    else:
+        plantDataB = runStages(plantData, exclusionRules, runLog, reportMemory, export)
+    with runLog.stage("export", rowsIn=len(plantDataB)) as record:
+        exportData(plantDataB, outputFormat, export)
+        record["rowsOut"] = len(plantDataB)
+    runLog.write("PetrinexBalancing")
+    return plantDataB
+
+
+def runStages(plantData, exclusionRules, runLog, reportMemory=False, export="rows"):
+    with runLog.stage("preprocessColumns", rowsIn=len(plantData)) as record:
+        plantDataPP = preprocessColumns(plantData)
+        record["rowsOut"] = len(plantDataPP)
+    if reportMemory:
+        memoryUsage(plantDataPP, "preprocessColumns")
+    with runLog.stage("balanceData", rowsIn=len(plantDataPP)) as record:
+        plantDataB = balanceData(plantDataPP)
+        record["rowsOut"] = len(plantDataB)
+    if reportMemory:
+        memoryUsage(plantDataB, "balanceData")
+    if exportRows(export):
+        plantDataB.to_csv('plantDataUnbalancedControl.csv', index=False)
+    # the exclusion rules' rows are taken off the unbalanced plants' sums rather than balancing them again
+    with runLog.stage("rebalanceData", rowsIn=len(plantDataB)) as record:
+        plantDataB = rebalance(plantDataB, exclusionRules)
+        record["rowsOut"] = len(plantDataB)
+    if reportMemory:
+        memoryUsage(plantDataB, "rebalanceData")
+    return plantDataB
+
+
+def runShardedStages(plantData, exclusionRules, workers, runLog, reportMemory=False, export="rows"):
+    # the same stages as runStages with a shard of the facilities in each worker, the merged
+    # rows come out in the same order as runStages gives them
+    with runLog.stage("balanceShards", rowsIn=len(plantData)) as record:
+        plantDataControl, plantDataB = runShards(plantData, partial(balanceShard, exclusionRules=exclusionRules,
+                                                                    keepControl=exportRows(export)), workers)
+        record["rowsOut"] = len(plantDataB)
+    print(f"Balanced the facilities in {workers} shards\n")
+    if plantDataControl is not None:
+        reportUnbalanced(plantDataControl)
+        plantDataControl.to_csv('plantDataUnbalancedControl.csv', index=False)
+    reportUnbalanced(plantDataB)
+    if reportMemory:
+        memoryUsage(plantDataB, "rebalanceData")
+    return plantDataB
+
 def main():
     # set the name path to the data
     plantDataCSV = "ABPlantDataDec22.CSV"
     activityCodesCSV = "activityCodeFactors.csv"
-    
-    plantData = readData(plantDataCSV, activityCodesCSV)
-    plantDataPP = preprocessColumns(plantData)
-    plantDataB = balanceData(plantDataPP)
-    plantDataB.to_csv('plantDataUnbalancedControl.csv', index=False)
-    plantDataRB = rebalanceData(plantDataB)
-    plantDataB = balanceData(plantDataRB)
-    exportData(plantDataB)
+    exclusionRulesCSV = "exclusionRules.csv"
+    # set compactMemory to True to hold the identifier columns as categoricals,
+    # and reportMemory to True to print the memory used after each stage
+    compactMemory = False
+    reportMemory = False
+    # set profileRun to True to time each stage and save the times, peak memory and row counts to a run log
+    profileRun = False
+    # set export to "breakdown" to write the unbalanced plants' balance by activity and product
+    # instead of all their rows, or "both" for both files
+    export = "rows"
+    # set maxPasses to stop the rebalance after that many passes when exclusionRules.csv has a Pass column
+    maxPasses = None
+    # set workers above 1 to balance the facilities in that many shards in worker processes
+    workers = 1
+    
+    run(plantDataCSV, activityCodesCSV, exclusionRulesCSV, "csv", compactMemory, reportMemory, profileRun, export, maxPasses,
+        workers)
     return 
 
-main()
-    
+
+# only run main when the script is run directly, the command line imports this file
+if __name__ == "__main__":
+    main()
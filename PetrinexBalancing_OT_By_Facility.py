@@ -22,91 +22,211 @@ import pandas as pd
 import datetime as dt
 import numpy as np
 import os
+import json
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from petrinex.rules import readExclusionRules, exclusionMask
+from petrinex.rebalance import balanceLimit
+from petrinex.volume import parseVolume, reportVolume
+from petrinex.memory import compactFrame, memoryUsage
+from petrinex.output import ResultSink, outputFileName
+from petrinex.store import ResultStore
+from petrinex.profiling import RunLog, collectRecords
+from petrinex.files import volumeFileName, inferTypes, csvSource
+from petrinex.factors import readActivityFactors, attachFactors
+from petrinex.panel import PanelBuilder
+from petrinex.breakdown import BreakdownBuilder, exportRows, exportBreakdown
+from petrinex.prefetch import prefetch
 
-def readData(DataCSV, ACodesCSV, facilityList):
-    # read in the two csv files
-    plantData = pd.read_csv(DataCSV, usecols=['ProductionMonth', 'OperatorName', 'ReportingFacilityID','ReportingFacilityType', 
-                                              'ReportingFacilitySubType', 'ReportingFacilityID','ReportingFacilityName',
-                                              'ReportingFacilitySubTypeDesc', 'ReportingFacilityLocation', 'FacilityLegalSubdivision',
-                                              'FacilitySection','FacilityTownship', 'FacilityRange', 'FacilityMeridian',
-                                               'ProductID','Volume','Energy','ActivityID'])
-                                              
-    plant_AC = pd.read_csv(ACodesCSV)
+# the columns we pull out of the monthly volumetric files
+dataColumns = ['ProductionMonth', 'OperatorName', 'ReportingFacilityID','ReportingFacilityType', 
+               'ReportingFacilitySubType', 'ReportingFacilityID','ReportingFacilityName',
+               'ReportingFacilitySubTypeDesc', 'ReportingFacilityLocation', 'FacilityLegalSubdivision',
+               'FacilitySection','FacilityTownship', 'FacilityRange', 'FacilityMeridian',
+               'ProductID','Volume','Energy','ActivityID']
+
+# folder (in the working folder unless another is given) that holds the columnar copies of each month,
+# kept apart from the monthly csv files so they can sit on a read-only or shared folder
+cacheFolder = "PetrinexCache"
+# bump this when the layout of the cache files changes so old copies get rebuilt
+cacheVersion = 3
+# rows per parquet row group, the facility index points at these so smaller groups
+# mean less is read when only a few facilities are asked for
+rowGroupSize = 10000
+
+# number of csv rows read at a time, memory is bounded by this rather than the size of the month
+chunkSize = 100000
+
+def readChunks(DataCSV, columns=None):
+    # iterator over the month chunkSize rows at a time, all columns read as text
+    # zipped or compressed months are decompressed a chunk at a time, see petrinex/files.py
+    # the file is closed again once the last chunk has been read
+    with csvSource(DataCSV) as source, pd.read_csv(source, usecols=columns, dtype=str, chunksize=chunkSize) as chunks:
+        yield from chunks
+
+def streamMonth(DataCSV, facilityList):
+    # keep only the rows for the requested facilities as each chunk is read, every row when facilityList is None
+    chunks = [chunk if facilityList is None else chunk[chunk["ReportingFacilityID"].isin(facilityList)]
+              for chunk in readChunks(DataCSV, dataColumns)]
+    if len(chunks) == 0:
+        with csvSource(DataCSV) as source:
+            return pd.DataFrame(columns=[c for c in pd.read_csv(source, nrows=0).columns if c in dataColumns])
+    return inferTypes(pd.concat(chunks, ignore_index=True))
+
+def cachePaths(DataCSV, folder=cacheFolder):
+    # the parquet file and the fingerprint file that sits beside it
+    name = os.path.basename(DataCSV)
+    return os.path.join(folder, name + ".parquet"), os.path.join(folder, name + ".json")
+
+def sourceFingerprint(DataCSV):
+    # the path, size and modified time of the csv, if any of them changes the cache is rebuilt
+    # (the path as months of the same name from different folders share the cache folder)
+    stat = os.stat(DataCSV)
+    return {"source": os.path.abspath(DataCSV), "size": stat.st_size, "mtime": stat.st_mtime_ns, "version": cacheVersion}
+
+def buildCache(DataCSV, folder=cacheFolder):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    
+    parquetPath, fingerprintPath = cachePaths(DataCSV, folder)
+    os.makedirs(folder, exist_ok=True)
+    fingerprint = sourceFingerprint(DataCSV)
     
-    facilityList = facilityList
-    plantData = plantData[plantData["ReportingFacilityID"].isin(facilityList)]
+    # every column is stored as text apart from volume which is cleaned to a float
+    with csvSource(DataCSV) as source:
+        columns = list(pd.read_csv(source, nrows=0).columns)
+    schema = pa.schema([(c, pa.float64() if c == "Volume" else pa.string()) for c in columns])
+    
+    # the month is converted a chunk at a time and written out rowGroupSize rows per row group,
+    # while writing we index which row groups each facility has rows in
+    # write to a temporary name first so a half written file is never picked up
+    rowGroups = {}
+    rowGroup = 0
+    maskedTotal = 0
+    unparseableTotal = 0
+    try:
+        with pq.ParquetWriter(parquetPath + ".tmp", schema) as writer:
+            for chunk in readChunks(DataCSV):
+                volume, masked, unparseable = parseVolume(chunk["Volume"])
+                chunk["Volume"] = volume
+                maskedTotal += masked
+                unparseableTotal += unparseable
+                for start in range(0, len(chunk), rowGroupSize):
+                    group = chunk.iloc[start:start + rowGroupSize]
+                    writer.write_table(pa.Table.from_pandas(group, schema=schema, preserve_index=False))
+                    for facilityID in group["ReportingFacilityID"].dropna().unique():
+                        rowGroups.setdefault(facilityID, []).append(rowGroup)
+                    rowGroup += 1
+    except BaseException:
+        # a full disk halfway through leaves nothing behind
+        if os.path.exists(parquetPath + ".tmp"):
+            os.remove(parquetPath + ".tmp")
+        raise
+    os.replace(parquetPath + ".tmp", parquetPath)
+    reportVolume(maskedTotal, unparseableTotal)
+    fingerprint["columns"] = columns
+    fingerprint["rowGroups"] = rowGroups
+    with open(fingerprintPath + ".tmp", "w") as f:
+        json.dump(fingerprint, f)
+    os.replace(fingerprintPath + ".tmp", fingerprintPath)
+    print(f"Cache has been built for {DataCSV}\n")
+    return fingerprint
+
+def cacheIndex(DataCSV, folder=cacheFolder):
+    # returns the stored columns and facility index for the month, rebuilding the cache if the csv has changed
+    parquetPath, fingerprintPath = cachePaths(DataCSV, folder)
+    if os.path.exists(parquetPath) and os.path.exists(fingerprintPath):
+        with open(fingerprintPath) as f:
+            fingerprint = json.load(f)
+        current = sourceFingerprint(DataCSV)
+        if all(fingerprint.get(key) == current[key] for key in current):
+            return fingerprint
+    return buildCache(DataCSV, folder)
+
+def parquetAvailable():
+    # parquet support comes from pyarrow, without it we fall back to reading the csv
+    try:
+        import pyarrow
+    except ImportError:
+        return False
+    return True
+
+def readMonth(DataCSV, facilityList, useCache=True, cacheFolder=cacheFolder):
+    if useCache and parquetAvailable():
+        import pyarrow.parquet as pq
+        
+        # a cache folder that can't be written to means the month is read from the csv instead,
+        # a month that isn't there is still reported as missing
+        try:
+            index = cacheIndex(DataCSV, cacheFolder)
+        except OSError as error:
+            if not os.path.exists(DataCSV):
+                raise
+            print(f"The cache couldn't be written to {cacheFolder} ({error}), {DataCSV} is read from the csv\n")
+            return streamMonth(DataCSV, facilityList)
+        
+        # only read the projected columns, kept in the same order as the csv, and
+        # only the row groups the index says hold rows for the requested facilities
+        # (a facilityList of None reads the whole month)
+        columns = [c for c in index["columns"] if c in dataColumns]
+        parquetFile = pq.ParquetFile(cachePaths(DataCSV, cacheFolder)[0])
+        if facilityList is None:
+            return inferTypes(parquetFile.read(columns=columns).to_pandas())
+        rowGroups = sorted({g for facilityID in facilityList for g in index["rowGroups"].get(facilityID, [])})
+        plantData = parquetFile.read_row_groups(rowGroups, columns=columns).to_pandas()
+        plantData = plantData[plantData["ReportingFacilityID"].isin(facilityList)]
+        return inferTypes(plantData)
+    return streamMonth(DataCSV, facilityList)
+
+def readData(DataCSV, activityFactors, facilityList, useCache=True, compact=False, cacheFolder=cacheFolder):
+    # read in the csv file, only the rows for the facilities in facilityList are kept (all of them when it is None)
+    # activityFactors is the table readActivityFactors read at the start of the run
+    plantData = readMonth(DataCSV, facilityList, useCache, cacheFolder)
     
-    plantData["Volume"] = plantData["Volume"].fillna(0)
+    # convert volume to float as the data comes in, masked and blank volumes become 0
+    # (the cache already holds volume as a float so this is just a copy there)
+    volume, masked, unparseable = parseVolume(plantData["Volume"])
+    plantData["Volume"] = volume
+    reportVolume(masked, unparseable)
     plantData = plantData.fillna("NaN")
     
-    # merge the two dataframes
-    plantData = pd.merge(plantData, plant_AC, on= 'ActivityID', how = 'left')
-    plantData["Factor"] = plantData["Factor"].fillna(0)
+    # in compact mode the identifier columns become categoricals, see petrinex/memory.py
+    if compact:
+        plantData = compactFrame(plantData)
+    
+    # attach each row's factor, rows with an activity that isn't in the table get 0, see petrinex/factors.py
+    plantData = attachFactors(plantData, activityFactors, unknownFactor=0)
     return plantData
 
-def preprocessColumns(plantData):
+def restoreMissing(plantData):
+    # readData fills the blanks with "NaN" text, they go back to missing before the rows are
+    # written so the master file has blank cells there like it did when the months were
+    # saved to csv and read back in
+    missing = {}
+    for column in plantData.columns:
+        values = plantData[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            if "NaN" in values.cat.categories:
+                missing[column] = values.cat.remove_categories(["NaN"])
+        elif values.dtype == object:
+            filled = (values == "NaN").to_numpy()
+            if filled.any():
+                missing[column] = values.mask(filled)
+    return plantData.assign(**missing)
+
+def preprocessColumns(plantData, exclusionRules):
     ###########################
     #clean and format the data#
     ###########################
-    #set the volume column to string **edge case**
-    plantData['Volume'] = plantData['Volume'].astype(str)
-    
-    # fixing errors in the volume data
-    # Relace the commas with empty string
-    plantData['Volume'] = plantData['Volume'].str.replace(',','')
-
-    # Replace the *** with empty string
-    plantData['Volume'] = plantData['Volume'].replace(to_replace='\*\*\*', value='0', regex=True)
-    
-    # Replace the blanks with 0
-    plantData["Volume"] = plantData["Volume"].fillna(0)
-    
-    # converted volume to float to be able to balance out the volumes via activity
-    plantData["Volume"] = pd.to_numeric(plantData["Volume"])
+    # volume was already converted to float in readData, see petrinex/volume.py
     
     #############################################################################
     # here we set to null values that aren't nessecary for the balancing process#
     #############################################################################
     
-    activityList = ['FLARE']
-    productList = ['ENTGAS']
-    activityID = plantData['ActivityID']
-    productID = plantData['ProductID']
-    counter = 0
-    
-    # loop through each activity and product pair
-    for (activity, product) in zip(activityList, productList):
-        # List conditions
-        conditions = [
-            (productID == "SAND"), # condition for sand
-            # conditions for combination 'activity * product'
-            (activityID == activity) & (productID == product), # condition 1
-            # other conditions
-            (activityID != activity) & (productID != product), # condition 2
-            (activityID == activity) & (productID != product), # condition 3
-            (activityID != activity) & (productID == product) # condition 4
-        ]
-        # List of values to return
-        choices = [
-            0, # if condition SAND is true
-            0, # if condition 1 is true
-            1, # if condition 2 is true
-            1, # if condition 3 is true
-            1 # if condition 4 is true
-        ]
-        # create a new column and use np.select to assign values to it using our lists as arguments
-        header = 'NullCombination' + str(counter)
-        plantData[header] = np.select(conditions, choices, default=0)
-        counter += 1
-    
-    nullCombinationList = []
-    # remove the rows where null combination is 0
-    for i in range(counter):
-        header = 'NullCombination' + str(i)
-        nullCombinationList.append(header) 
-    # create a new column that is the product of all the null combinations
-    plantData['nullFactor'] = plantData.loc[:, nullCombinationList].prod(axis=1)
-    plantData = plantData.drop(nullCombinationList, axis=1)
+    # rows matching an exclusion rule (e.g. FLARE * ENTGAS, or any SAND) get a nullFactor of 0
+    # every rule is checked in one pass, see petrinex/rules.py
+    plantData['nullFactor'] = np.where(exclusionMask(plantData, exclusionRules), 0, 1)
     return plantData
    
 def balanceData(plantData):
@@ -116,28 +236,25 @@ def balanceData(plantData):
     # drop the variables that we aren't interested in
     plantData = plantData.drop(columns=['nullFactor'])
     
-    # now we can get all the unique ReportingFacilityID and sum up the balance values
-    plantIDs = plantData[["ReportingFacilityID", "Balance"]].copy()
-    
-    # now we can join and transform each plant ID and sum up the balance values
-    plantIDs = plantIDs.join(plantIDs.groupby("ReportingFacilityID").transform(sum).add_prefix('sum'))
+    # give every ReportingFacilityID a number and sum up the balance values for each plant ID in one pass
+    facilityCodes, facilityIDs = pd.factorize(plantData["ReportingFacilityID"])
+    sums = plantData["Balance"].groupby(facilityCodes).sum().reindex(range(len(facilityIDs))).to_numpy()
     
-    # drop balance column and duplicates to get final list of balanced plant ids
-    plantIDs = plantIDs.drop(columns=['Balance']).drop_duplicates()
+    # look up each row's sum by its plant number, rows with no plant ID get code -1 which picks up the NaN on the end
+    sumBalance = np.append(sums, np.nan)[facilityCodes]
     
     ##############################################################################
     # run a check to see if the sum of the balance values is 0 for each plant ID #
     ##############################################################################
     
     # if the sum is not 0, then the plant ID is unbalanced
-    plantsUnbalanced = plantIDs[(plantIDs['sumBalance'] > 0.05) | (plantIDs['sumBalance'] < -0.05)]
-    plantsUnbalanced['Unbalanced/Balanced'] = "Unbalanced"
-    countUnbalanced = len(plantsUnbalanced['ReportingFacilityID'])
+    unbalanced = (sumBalance > balanceLimit) | (sumBalance < -balanceLimit)
+    countUnbalanced = int(((sums > balanceLimit) | (sums < -balanceLimit)).sum())
     
     # if the sum is 0, then the plant ID is balanced
-    plantsBalanced = plantIDs[(plantIDs['sumBalance'] < 0.05) & (plantIDs['sumBalance'] > -0.05)]
-    plantsBalanced['Unbalanced/Balanced'] = "Balanced"
-    countBalanced = len(plantsBalanced['ReportingFacilityID'])
+    # (a sum of exactly +/-balanceLimit is neither, those plants are left out of the output)
+    balanced = (sumBalance < balanceLimit) & (sumBalance > -balanceLimit)
+    countBalanced = int(((sums < balanceLimit) & (sums > -balanceLimit)).sum())
     countPlants = countUnbalanced + countBalanced
     
     # basic grammar nested loop 
@@ -158,10 +275,11 @@ def balanceData(plantData):
             print(f"and {countUnbalanced} plants have not been properly balanced.\n")
             print(f"Whereas {countBalanced} plants have been properly balanced.\n")
     
-    # merge the unbalanced plant data with the balanced plant data
-    plantDataUnbalanced = pd.merge(plantData, plantsUnbalanced, on= 'ReportingFacilityID')
-    plantDataBalanced = pd.merge(plantData, plantsBalanced, on= 'ReportingFacilityID')
-    plantData = pd.concat([plantDataBalanced, plantDataUnbalanced], ignore_index=True)
+    # put the balanced plant rows ahead of the unbalanced ones and attach the sums and labels
+    order = np.concatenate([np.flatnonzero(balanced), np.flatnonzero(unbalanced)])
+    plantData = plantData.take(order).reset_index(drop=True)
+    plantData["sumBalance"] = sumBalance[order]
+    plantData["Unbalanced/Balanced"] = np.where(unbalanced[order], "Unbalanced", "Balanced")
     plantData = plantData.sort_values(by=['sumBalance'])
 
     # round the Sum and balance values
@@ -180,9 +298,170 @@ def monthYearIterator(startMonth, startYear, endMonth, endYear):
             month = 1
             year += 1
 
+def loadMonth(date, facilityList, activityFactors, compactMemory=False, province="AB", inputFolder="", cacheFolder=cacheFolder):
+    # readData for a month by its date, this is the part that can be read ahead, see petrinex/prefetch.py
+    # then we need to create a string that is the name of the csv file
+    plantDataCSV = volumeFileName(date, province, inputFolder)
+    return readData(plantDataCSV, activityFactors, facilityList, compact=compactMemory, cacheFolder=cacheFolder)
+
+def processMonth(date, facilityList, activityFactors, exclusionRules, compactMemory=False, reportMemory=False, profile=False,
+                 province="AB", inputFolder="", pending=None, cacheFolder=cacheFolder):
+    # runs the balancing process for a single month, months don't depend on each other
+    # so this can be run in a worker process. returns None if the plants have no data that month
+    # the stage records are handed back with the result so they make it out of a worker process
+    # pending is the month already being read in the background, if it was read ahead
+    runLog = RunLog(profile)
+    
+    # functions in the program
+    with runLog.stage("month", month=date) as monthRecord:
+        # when the month was read ahead this stage is only the time spent waiting for it
+        with runLog.stage("readData", month=date) as record:
+            if pending is not None:
+                plantData = pending.result()
+            else:
+                plantData = loadMonth(date, facilityList, activityFactors, compactMemory, province, inputFolder, cacheFolder)
+            record["rowsOut"] = len(plantData)
+        monthRecord["rowsIn"] = len(plantData)
+        facilityIDList = plantData['ReportingFacilityID']
+        if len(facilityIDList) == 0:
+            monthRecord["rowsOut"] = 0
+            return None, runLog.records
+        if reportMemory:
+            memoryUsage(plantData, f"{date} readData")
+        with runLog.stage("preprocessColumns", month=date, rowsIn=len(plantData)) as record:
+            plantDataPP = preprocessColumns(plantData, exclusionRules)
+            record["rowsOut"] = len(plantDataPP)
+        if reportMemory:
+            memoryUsage(plantDataPP, f"{date} preprocessColumns")
+        with runLog.stage("balanceData", month=date, rowsIn=len(plantDataPP)) as record:
+            plantDataB = balanceData(plantDataPP)
+            record["rowsOut"] = len(plantDataB)
+        if reportMemory:
+            memoryUsage(plantDataB, f"{date} balanceData")
+        monthRecord["rowsOut"] = len(plantDataB)
+    return plantDataB, runLog.records
+
+def runMonths(dateList, facilityList, activityFactors, exclusionRules, workers=1, compactMemory=False, reportMemory=False, runLog=None,
+              province="AB", inputFolder="", prefetchDepth=1, cacheFolder=cacheFolder):
+    # process the months in serial or spread them across a pool of processes
+    # map hands the results back in the same order as dateList
+    profile = runLog is not None and runLog.enabled
+    month = partial(processMonth, facilityList=facilityList, activityFactors=activityFactors,
+                    exclusionRules=exclusionRules, compactMemory=compactMemory, reportMemory=reportMemory,
+                    profile=profile, province=province, inputFolder=inputFolder, cacheFolder=cacheFolder)
+    # results are yielded one month at a time so they can be written out as they arrive
+    if workers <= 1:
+        # in serial the next prefetchDepth months are read on a background thread while this one is balanced
+        read = partial(loadMonth, facilityList=facilityList, activityFactors=activityFactors,
+                       compactMemory=compactMemory, province=province, inputFolder=inputFolder, cacheFolder=cacheFolder)
+        results = (month(date, pending=pending) for date, pending in prefetch(read, dateList, prefetchDepth))
+        yield from collectRecords(results, runLog)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            yield from collectRecords(executor.map(month, dateList), runLog)
+
+def run(dateList, facilityList, activityCodesCSV="activityCodeFactors.csv", exclusionRulesCSV="exclusionRules.csv",
+        workers=1, outputFormat="csv", province="AB", inputFolder="", useResultStore=True,
+        compactMemory=False, reportMemory=False, profileRun=False, panel=None, prefetchDepth=1, export="rows",
+        cacheFolder=cacheFolder):
+    # balances the facilities over every month in dateList into the master file, main and the
+    # command line (petrinex/cli.py) both call this
+    # panel is None, "facility" or "product", see petrinex/panel.py
+    # export is rows, breakdown or both, see petrinex/breakdown.py
+    # cacheFolder is where the columnar copies of the months are kept
+    exclusionRules = readExclusionRules(exclusionRulesCSV)
+    activityFactors = readActivityFactors(activityCodesCSV)
+    runLog = RunLog(profileRun)
+    #################################################################################
+    # flag to check if plant is in database
+    plantDataCSV = volumeFileName(dateList[-1], province, inputFolder)
+    plantData = readData(plantDataCSV, activityFactors, facilityList, cacheFolder=cacheFolder)
+    facilityIDList = plantData['ReportingFacilityID']
+    if len(facilityIDList) == 0:
+        print(f"There is no data for {facilityList} in the database\n")
+        return
+    #################################################################################
+    
+    # months already in the result store with the same inputs are loaded instead of balanced again
+    storedMonths = set()
+    if useResultStore:
+        store = ResultStore("OT_By_Facility", activityCodesCSV, exclusionRules, facilityList)
+        storedMonths = {date for date in dateList if store.isCurrent(date, volumeFileName(date, province, inputFolder))}
+        print(f"{len(storedMonths)} months were loaded from the result store, {len(dateList) - len(storedMonths)} months need to be balanced\n")
+    newMonths = runMonths([date for date in dateList if date not in storedMonths], facilityList,
+                          activityFactors, exclusionRules, workers, compactMemory, reportMemory, runLog,
+                          province, inputFolder, prefetchDepth, cacheFolder)
+    
+    # balance every month, the results come back in month order and are
+    # appended straight to the master file
+    fileNameEXP = outputFileName("PlantDataBalancedMaster", outputFormat)
+    sink = ResultSink(fileNameEXP, outputFormat) if exportRows(export) else None
+    breakdown = BreakdownBuilder() if exportBreakdown(export) else None
+    panelBuilder = PanelBuilder(byProduct=panel == "product") if panel is not None else None
+    with runLog.stage("monthLoop") as loopRecord:
+        for date in dateList:
+            if date in storedMonths:
+                with runLog.stage("loadStored", month=date) as record:
+                    plantDataB = store.load(date)
+                    record["rowsOut"] = 0 if plantDataB is None else len(plantDataB)
+            else:
+                plantDataB = next(newMonths)
+                if useResultStore:
+                    store.save(date, volumeFileName(date, province, inputFolder), plantDataB)
+            if panelBuilder is not None:
+                panelBuilder.add(date, plantDataB)
+            if plantDataB is None:
+                print(f"There is no data for the month of {date} for the following plants you selected:\n")
+            else:
+                with runLog.stage("export", month=date, rowsIn=len(plantDataB)) as record:
+                    plantDataB = restoreMissing(plantDataB)
+                    if sink is not None:
+                        sink.write(plantDataB)
+                    if breakdown is not None:
+                        breakdown.add(plantDataB)
+                    record["rowsOut"] = len(plantDataB)
+        with runLog.stage("export"):
+            if sink is not None:
+                sink.close()
+            if breakdown is not None:
+                # only the unbalanced plants make it into the breakdown
+                breakdown.write(outputFileName("PlantDataBreakdownMaster", outputFormat), outputFormat)
+        loopRecord["rowsOut"] = sink.rows if sink is not None else None
+    if sink is not None:
+        print(f"The {outputFormat} file has been created and saved as {fileNameEXP}, for the following plants you selected:\n")
+    if panelBuilder is not None:
+        # the facility by month sums and what they show over the whole range
+        imbalancePanel = panelBuilder.panel()
+        imbalancePanel.save("PlantDataBalancePanel.npz")
+        panelSummary = imbalancePanel.summary()
+        panelSummary.to_csv("PlantDataBalancePanelSummary.csv", index=False)
+        print(panelSummary)
+        print("\nThe imbalance panel has been saved as PlantDataBalancePanel.npz and summarized in PlantDataBalancePanelSummary.csv\n")
+    runLog.write("PetrinexBalancing_OT_By_Facility")
+    return 
+
 def main():
     # activity code factors path
     activityCodesCSV = "activityCodeFactors.csv"
+    # activity and product pairs left out of the balance
+    exclusionRulesCSV = "exclusionRules.csv"
+    # set compactMemory to True to hold the identifier columns as categoricals,
+    # and reportMemory to True to print the memory used after each stage
+    compactMemory = False
+    reportMemory = False
+    # keep each month's result in PetrinexResults so a rerun only balances new or changed months
+    useResultStore = True
+    # set profileRun to True to time each stage of each month and save the times, peak memory
+    # and row counts to a run log
+    profileRun = False
+    # set panel to "facility" to save the facility by month sums as a NumPy panel with a
+    # summary of the imbalance over time, or "product" to split them by product as well
+    panel = None
+    # months read ahead on a background thread when running one month at a time, 0 to turn it off
+    prefetchMonths = 1
+    # set export to "breakdown" to write the unbalanced plants' balance by activity and product
+    # instead of all their rows, or "both" for both files
+    export = "rows"
     
     #################################################################################
     ############ bounds for month and year ##########################################
@@ -207,20 +486,10 @@ def main():
             break
         else:
             facilityList.append(facilityID)
+    workers = int(input("Enter the number of worker processes (press enter to run one month at a time): ") or 1)
+    outputFormat = input("Enter the output format, csv or parquet (press enter for csv): ").lower() or "csv"
     #################################################################################
-    # flag to check if plant is in database
-    if len(str(monthBound)) == 1:
-        date = f"{yearBound}-0{monthBound}"
-    else:
-        date = f"{yearBound}-{monthBound}"
-    plantDataCSV = f"Vol_{date}-AB.CSV"
-    plantData = readData(plantDataCSV, activityCodesCSV, facilityList)
-    facilityIDList = plantData['ReportingFacilityID']
-    if len(facilityIDList) == 0:
-        print(f"There is no data for {facilityList} in the database\n")
-        exit()
-    #################################################################################
-    csvOutputList = []
+    dateList = []
     # loop to run all functions over the desired date range
     # set start year and month to 1 and 2015 respectively
     # set end year and month to the current month and year
@@ -230,32 +499,14 @@ def main():
             date = f"{y}-0{m}"
         else:
             date = f"{y}-{m}"
-        # then we need to create a string that is the name of the csv file
-        plantDataCSV = f"Vol_{date}-AB.CSV"
-        
-        # functions in the program
-        plantData = readData(plantDataCSV, activityCodesCSV, facilityList)
-        facilityIDList = plantData['ReportingFacilityID']
-        if len(facilityIDList) == 0:
-            print(f"There is no data for the month of {date} for the following plants you selected:\n")
-        else:
-            plantDataPP = preprocessColumns(plantData)
-            plantDataB = balanceData(plantDataPP)
-            csvOutput = "PlantDataBalancedMaster" + date + ".csv"
-            plantDataB.to_csv(csvOutput, index=False)
-            csvOutputList.append(csvOutput)
-    
-    print("Combining all the months into one csv file...")
-    df_concat = pd.concat([pd.read_csv(f) for f in csvOutputList], ignore_index=True)
-    x = df_concat.info()
-    print(x)
-    fileNameEXP = "PlantDataBalancedMaster.csv"
-    df_concat.to_csv(fileNameEXP, index=False)
+        dateList.append(date)
     
-    # remove all the csv files that were created
-    for files in csvOutputList:
-        os.remove(files)
-    print(f"The csv file has been created and saved as {fileNameEXP}, for the following plants you selected:\n")
+    run(dateList, facilityList, activityCodesCSV, exclusionRulesCSV, workers, outputFormat,
+        useResultStore=useResultStore, compactMemory=compactMemory, reportMemory=reportMemory, profileRun=profileRun,
+        panel=panel, prefetchDepth=prefetchMonths, export=export)
     return 
-    
-main()
+
+
+# only run main when the script is run directly, worker processes import this file
+if __name__ == "__main__":
+    main()
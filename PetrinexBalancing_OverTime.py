@@ -20,26 +20,51 @@ change include:
 """
 
 import pandas as pd
-import seaborn as sns
-import matplotlib.pyplot as plt
 import datetime as dt
 import numpy as np
+from petrinex.rules import readExclusionRules, limitPasses
+from petrinex.rebalance import rebalance, balanceLimit
+from petrinex.volume import parseVolume, reportVolume
+from petrinex.memory import compactFrame, fillMissing, memoryUsage
+from petrinex.output import ResultSink, outputFileName
+from petrinex.profiling import RunLog, collectRecords
+from petrinex.files import volumeFileName, csvSource
+from petrinex.factors import readActivityFactors, attachFactors
+from petrinex.breakdown import BreakdownBuilder, exportRows, exportBreakdown
+from petrinex.engines import balanceSums, readFacilities, compareEngines
+from petrinex.prefetch import prefetch
+from petrinex.changes import MonthHistory, facilityHashes, facilityStates, changedFacilities, changeReport
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
+# the variables that we aren't interested in, readData and the arrow engine both leave these out
+dropColumns = ['ReportingFacilityProvinceState', 'ReportingFacilityType', 'ReportingFacilityIdentifier',
+               'ReportingFacilitySubTypeDesc','FacilityLegalSubdivision', 'FacilitySection', 'FacilityTownship', 
+               'FacilityRange', 'FacilityMeridian','FromToIDProvinceState', 'FromToIDType', 'FromToIDIdentifier',
+               'Hours', 'ProrationProduct', 'ProrationFactor', 'Heat']
 
-def readData(DataCSV, ACodesCSV):
-    # read in the two csv files
-    plantData = pd.read_csv(DataCSV)
-    plant_AC = pd.read_csv(ACodesCSV)
+
+def readData(DataCSV, activityFactors, compact=False):
+    # read in the csv file, activityFactors is the table readActivityFactors read at the start of the run
+    with csvSource(DataCSV) as source:
+        plantData = pd.read_csv(source)
     print("Data has been read\n")
     
     # drop the variables that we aren't interested in
-    plantData = plantData.drop(columns=['ReportingFacilityProvinceState', 'ReportingFacilityType', 'ReportingFacilityIdentifier',
-                                          'ReportingFacilitySubTypeDesc','FacilityLegalSubdivision', 'FacilitySection', 'FacilityTownship', 
-                                          'FacilityRange', 'FacilityMeridian','FromToIDProvinceState', 'FromToIDType', 'FromToIDIdentifier',
-                                          'Hours', 'ProrationProduct', 'ProrationFactor', 'Heat'])
+    plantData = plantData.drop(columns=dropColumns)
+    
+    # convert volume to float as the data comes in, masked and blank volumes become 0
+    volume, masked, unparseable = parseVolume(plantData["Volume"])
+    plantData["Volume"] = volume
+    reportVolume(masked, unparseable)
+    print("Volume data has been converted to float\n")
     
-    # merge the two dataframes
-    plantData = pd.merge(plantData, plant_AC, on= 'ActivityID')
+    # in compact mode the identifier columns become categoricals, see petrinex/memory.py
+    if compact:
+        plantData = compactFrame(plantData)
+    
+    # attach each row's factor, rows with an activity that isn't in the table are left out, see petrinex/factors.py
+    plantData = attachFactors(plantData, activityFactors)
     print("Data has been merged\n")
     
     return plantData
@@ -50,20 +75,9 @@ def preprocessColumns(plantData):
     #clean and format the data#
     ###########################
     
-    # fixing errors in the volume data
-    # Relace the commas with empty string
-    plantData['Volume'] = plantData['Volume'].str.replace(',','')
-
-    # Replace the *** with empty string
-    plantData['Volume'] = plantData['Volume'].replace(to_replace='\*\*\*', value='0', regex=True)
-
-    # Replace NaN with 0 for Volume
-    #plantData['Volume'] = plantData['Volume'].fillna(0)
-    plantData = plantData.fillna(0)
-    
-    # converted volume to float to be able to balance out the volumes via activity
-    plantData["Volume"] = pd.to_numeric(plantData["Volume"])
-    print("Volume data has been converted to float\n")
+    # volume was already converted to float in readData, see petrinex/volume.py
+    # Replace NaN with 0
+    plantData = fillMissing(plantData, 0)
     
 
     
@@ -88,71 +102,25 @@ def balanceData(plantData):
     # create a new column that is the volume multiplied by the factor
     plantData["Balance"] = plantData["Volume"]*plantData["Factor"]
     
-    # now we can get all the unique ReportingFacilityID and sum up the balance values
-    plantIDs = plantData[["ReportingFacilityID", "Balance"]].copy()
-    
-    # now we can join and transform each plant ID and sum up the balance values
-    plantIDs = plantIDs.join(plantIDs.groupby("ReportingFacilityID").transform(sum).add_prefix('sum'))
+    # give every ReportingFacilityID a number and sum up the balance values for each plant ID in one pass
+    facilityCodes, facilityIDs = pd.factorize(plantData["ReportingFacilityID"])
+    sums = plantData["Balance"].groupby(facilityCodes).sum().reindex(range(len(facilityIDs))).to_numpy()
     
-    # drop balance column and duplicates to get final list of balanced plant ids
-    plantIDs = plantIDs.drop(columns=['Balance']).drop_duplicates()
+    # look up each row's sum by its plant number, rows with no plant ID get code -1 which picks up the NaN on the end
+    sumBalance = np.append(sums, np.nan)[facilityCodes]
     
     # run a check to see if the sum of the balance values is 0 for each plant ID
-    doesNotEqualZero = plantIDs[(plantIDs['sumBalance'] > 0.05) | (plantIDs['sumBalance'] < -0.05)]
+    doesNotEqualZero = pd.DataFrame({"ReportingFacilityID": facilityIDs, "sumBalance": sums})
+    doesNotEqualZero = doesNotEqualZero[(doesNotEqualZero['sumBalance'] > balanceLimit) | (doesNotEqualZero['sumBalance'] < -balanceLimit)]
     Count = len(doesNotEqualZero['ReportingFacilityID'])
     doesNotEqualZero = doesNotEqualZero.sort_values(by=['sumBalance'])
     print("There are " + str(Count) + " plants that have not been properly balanced:\n")
     print(doesNotEqualZero)
     
-    # merge the unbalanced plant data with the balanced plant data
-    plantData = pd.merge(plantData, doesNotEqualZero, on= 'ReportingFacilityID')
-    
-    return plantData
-
-
-def rebalanceData(plantData):
-    ######################################################################
-    # drop the rows where the activity is FLARE and the product is ENTGAS#
-    ######################################################################
-    
-    # maybe throw a hash map here and then we can group everything in pairs and have it loop through each pair
-    ############ iterate through each activity and product pair and create a new column that is 0 if the activity and product match the pair and 1 if they don't
-    activityList = ['FLARE']
-    productList = ['ENTGAS']
-    activityID = plantData['ActivityID']
-    productID = plantData['ProductID']
-    counter = 0
-    
-    # loop through each activity and product pair
-    for (activity, product) in zip(activityList, productList):
-        # List conditions
-        conditions = [
-            # conditions for combination 'activity * product'
-            (activityID == activity) & (productID == product), # condition 1
-            # other conditions
-            (activityID != activity) & (productID != product), # condition 2
-            (activityID == activity) & (productID != product), # condition 3
-            (activityID != activity) & (productID == product) # condition 4
-        ]
-        # List of values to return
-        choices = [
-            0, # if condition 1 is true
-            1, # if condition 2 is true
-            1, # if condition 3 is true
-            1 # if condition 4 is true
-        ]
-        # create a new column and use np.select to assign values to it using our lists as arguments
-        header = 'NullCombination' + str(counter)
-        plantData[header] = np.select(conditions, choices, default=0)
-        print("\n" + header + " has been created\n")
-        counter += 1
-        
-    # remove the rows where null combination is 0
-    for i in range(counter):
-        header = 'NullCombination' + str(i)
-        plantData = plantData[plantData[header] != 0]
-    # drop Balance and sumBalance columns to rebalance
-    plantData = plantData.drop(columns=['Balance', 'sumBalance'])
+    # keep only the rows for the unbalanced plants and attach their sums
+    unbalanced = (sumBalance > balanceLimit) | (sumBalance < -balanceLimit)
+    plantData = plantData[unbalanced].reset_index(drop=True)
+    plantData["sumBalance"] = sumBalance[unbalanced]
     
     return plantData
 
@@ -189,13 +157,261 @@ def monthYearIterator(startMonth, startYear, endMonth, endYear):
             year += 1
 
 
+def readArrow(plantDataCSV, activityFactors, exclusionRules, compact=False):
+    # the arrow engine's readData, the month is summed by facility in arrow and only the rows of the
+    # plants that stay unbalanced after the exclusion rules are read in full, see petrinex/engines.py
+    sums = balanceSums(plantDataCSV, activityFactors, exclusionRules)
+    facilityList = sums.loc[sums["unbalanced"], "ReportingFacilityID"]
+    plantData = readFacilities(plantDataCSV, activityFactors, facilityList, dropColumns)
+    print(f"Data has been summed for {len(sums)} plants, the {len(facilityList)} unbalanced plants have been read\n")
+    if compact:
+        plantData = compactFrame(plantData)
+    return plantData
+
+
+def readMonth(date, activityFactors, exclusionRules, compactMemory=False, province="AB", inputFolder="", engine="pandas"):
+    # reads a month with the engine asked for, this is the part that can be read ahead, see petrinex/prefetch.py
+    plantDataCSV = volumeFileName(date, province, inputFolder)
+    if engine == "arrow":
+        return readArrow(plantDataCSV, activityFactors, exclusionRules, compactMemory)
+    return readData(plantDataCSV, activityFactors, compactMemory)
+
+
+def processMonth(date, activityFactors, exclusionRules, compactMemory=False, reportMemory=False, profile=False,
+                 province="AB", inputFolder="", engine="pandas", pending=None):
+    # runs the full balancing process for a single month, months don't depend on each other
+    # so this can be run in a worker process
+    # the stage records are handed back with the result so they make it out of a worker process
+    # engine is pandas, arrow or check, see petrinex/engines.py
+    # pending is the month already being read in the background, if it was read ahead
+    plantDataCSV = volumeFileName(date, province, inputFolder)
+    runLog = RunLog(profile)
+    
+    with runLog.stage("month", month=date) as monthRecord:
+        # when the month was read ahead this stage is only the time spent waiting for it
+        with runLog.stage("readData", month=date) as record:
+            if pending is not None:
+                plantData = pending.result()
+            else:
+                plantData = readMonth(date, activityFactors, exclusionRules, compactMemory, province, inputFolder, engine)
+            record["rowsOut"] = len(plantData)
+        if reportMemory:
+            memoryUsage(plantData, f"{date} readData")
+        with runLog.stage("preprocessColumns", month=date, rowsIn=len(plantData)) as record:
+            plantDataPP = preprocessColumns(plantData)
+            record["rowsOut"] = len(plantDataPP)
+        if reportMemory:
+            memoryUsage(plantDataPP, f"{date} preprocessColumns")
+        with runLog.stage("balanceData", month=date, rowsIn=len(plantDataPP)) as record:
+            plantDataB = balanceData(plantDataPP)
+            record["rowsOut"] = len(plantDataB)
+        if reportMemory:
+            memoryUsage(plantDataB, f"{date} balanceData")
+        # the exclusion rules' rows are taken off the unbalanced plants' sums rather than balancing them again
+        with runLog.stage("rebalanceData", month=date, rowsIn=len(plantDataB)) as record:
+            firstUnbalanced = plantDataB["ReportingFacilityID"]
+            plantDataB = rebalance(plantDataB, exclusionRules)
+            record["rowsOut"] = len(plantDataB)
+        if reportMemory:
+            memoryUsage(plantDataB, f"{date} rebalanceData")
+        if engine == "check":
+            with runLog.stage("checkEngines", month=date):
+                compareEngines(date, balanceSums(plantDataCSV, activityFactors, exclusionRules),
+                               firstUnbalanced, plantDataB["ReportingFacilityID"])
+        monthRecord["rowsIn"] = len(plantData)
+        monthRecord["rowsOut"] = len(plantDataB)
+    return plantDataB, runLog.records
+
+
+def updateMonth(date, history, activityFactors, exclusionRules, compactMemory=False, reportMemory=False, profile=False,
+                province="AB", inputFolder=""):
+    # processMonth for a month that may have been balanced before, see petrinex/changes.py. a month
+    # whose file hasn't changed is loaded from the history, a republished one only has the plants
+    # whose rows changed balanced again, along with the ones that were unbalanced last time
+    # returns the month's rows and the report of the plants that changed, None the first time a month is balanced
+    plantDataCSV = volumeFileName(date, province, inputFolder)
+    runLog = RunLog(profile)
+    
+    with runLog.stage("month", month=date) as monthRecord:
+        previous = history.load(date, province)
+        if history.isCurrent(previous, plantDataCSV):
+            print(f"{date} hasn't changed since it was balanced\n")
+            monthRecord["rowsOut"] = len(previous["result"])
+            return (previous["result"], None), runLog.records
+        with runLog.stage("readData", month=date) as record:
+            plantData = readData(plantDataCSV, activityFactors, compactMemory)
+            record["rowsOut"] = len(plantData)
+        with runLog.stage("hashRows", month=date, rowsIn=len(plantData)) as record:
+            hashes = facilityHashes(plantData)
+            if previous is None:
+                changed = hashes.index
+                rerun = plantData
+            else:
+                changed = changedFacilities(previous, hashes)
+                unbalancedBefore = previous["states"].index[previous["states"]["status"] == "Unbalanced"]
+                rerun = plantData[plantData["ReportingFacilityID"].isin(changed.union(unbalancedBefore))]
+                print(f"{len(changed)} plants have changed in {date}, {len(rerun)} rows are being balanced again\n")
+            record["rowsOut"] = len(rerun)
+        if reportMemory:
+            memoryUsage(rerun, f"{date} hashRows")
+        with runLog.stage("preprocessColumns", month=date, rowsIn=len(rerun)) as record:
+            plantDataPP = preprocessColumns(rerun)
+            record["rowsOut"] = len(plantDataPP)
+        with runLog.stage("balanceData", month=date, rowsIn=len(plantDataPP)) as record:
+            plantDataB = balanceData(plantDataPP)
+            record["rowsOut"] = len(plantDataB)
+        with runLog.stage("rebalanceData", month=date, rowsIn=len(plantDataB)) as record:
+            plantDataB, rebalancedSums = rebalance(plantDataB, exclusionRules, plantSums=True)
+            record["rowsOut"] = len(plantDataB)
+        
+        # the plants that weren't balanced again keep the states they had
+        states = facilityStates(plantDataPP, plantDataB, rebalancedSums)
+        changes = None
+        if previous is not None:
+            kept = previous["states"].drop(index=changed.union(states.index), errors="ignore")
+            states = pd.concat([kept, states])
+            changes = changeReport(date, previous["states"], states, changed)
+            print(f"{len(changes)} plants in {date} have a different status or sumBalance\n")
+        history.save(date, plantDataCSV, hashes, states, plantDataB, province)
+        monthRecord["rowsIn"] = len(plantData)
+        monthRecord["rowsOut"] = len(plantDataB)
+    return (plantDataB, changes), runLog.records
+
+
+def provinceMonth(item, month, labelProvince=False, **kwargs):
+    # runs month (processMonth or updateMonth) for a (province, date) pair, with labelProvince the
+    # stage records are labelled with the province as well so a batch's run log can tell them apart
+    province, date = item
+    result, records = month(date, province=province, **kwargs)
+    if labelProvince:
+        for record in records:
+            record["month"] = f"{date}-{province}"
+    return result, records
+
+
+def runMonths(monthList, activityFactors, exclusionRules, workers=1, compactMemory=False, reportMemory=False, runLog=None,
+              inputFolder="", engine="pandas", prefetchDepth=1, history=None, labelProvince=False):
+    # process the months in serial or spread them across a pool of processes, monthList is
+    # (province, date) pairs so the months of several provinces can share the one pool
+    # map hands the results back in the same order as monthList
+    profile = runLog is not None and runLog.enabled
+    month = partial(processMonth, activityFactors=activityFactors, exclusionRules=exclusionRules,
+                    compactMemory=compactMemory, reportMemory=reportMemory, profile=profile,
+                    inputFolder=inputFolder, engine=engine)
+    if history is not None:
+        month = partial(updateMonth, history=history, activityFactors=activityFactors, exclusionRules=exclusionRules,
+                        compactMemory=compactMemory, reportMemory=reportMemory, profile=profile,
+                        inputFolder=inputFolder)
+    month = partial(provinceMonth, month=month, labelProvince=labelProvince)
+    # results are yielded one month at a time so they can be written out as they arrive
+    if workers <= 1 and history is not None:
+        # with the history most months aren't read at all, so nothing is read ahead
+        yield from collectRecords(map(month, monthList), runLog)
+    elif workers <= 1:
+        # in serial the next prefetchDepth months are read on a background thread while this one is balanced
+        read = lambda item: readMonth(item[1], activityFactors, exclusionRules, compactMemory, item[0], inputFolder, engine)
+        results = (month(item, pending=pending) for item, pending in prefetch(read, monthList, prefetchDepth))
+        yield from collectRecords(results, runLog)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            yield from collectRecords(executor.map(month, monthList), runLog)
+
+
+def run(dateList, activityCodesCSV="activityCodeFactors.csv", exclusionRulesCSV="exclusionRules.csv", workers=1,
+        outputFormat="csv", province="AB", inputFolder="", compactMemory=False, reportMemory=False, profileRun=False,
+        engine="pandas", prefetchDepth=1, export="rows", maxPasses=None, trackChanges=False, provinces=None):
+    # balances every month in dateList into the master file, main and the command line
+    # (petrinex/cli.py) both call this
+    # export is rows, breakdown or both, see petrinex/breakdown.py
+    # maxPasses stops the rebalance after that many exclusion passes, see petrinex/rebalance.py
+    # trackChanges only balances the plants that changed since the last run, see petrinex/changes.py
+    # provinces balances the months of every province in the list in the same run instead of just
+    # province, they share the workers and the factor table and the output gets a Province column
+    exclusionRules = limitPasses(readExclusionRules(exclusionRulesCSV), maxPasses)
+    activityFactors = readActivityFactors(activityCodesCSV)
+    runLog = RunLog(profileRun)
+    history = None
+    if trackChanges:
+        if engine != "pandas":
+            raise ValueError("Tracking changes hashes every row of a month, it only runs with the pandas engine")
+        history = MonthHistory("OverTime", activityCodesCSV, exclusionRules)
+        changeSink = ResultSink(outputFileName("plantDataChanges", outputFormat), outputFormat)
+    
+    # balance every month, the results come back in month order (a province at a time in a
+    # batch) and are appended straight to the master file
+    provinceList = [province] if provinces is None else list(dict.fromkeys(provinces))
+    monthList = [(monthProvince, date) for monthProvince in provinceList for date in dateList]
+    batch = provinces is not None
+    sink = ResultSink(outputFileName("plantDataUnbalancedMaster", outputFormat), outputFormat) if exportRows(export) else None
+    breakdown = BreakdownBuilder() if exportBreakdown(export) else None
+    with runLog.stage("monthLoop") as loopRecord:
+        results = runMonths(monthList, activityFactors, exclusionRules, workers, compactMemory, reportMemory, runLog,
+                            inputFolder, engine, prefetchDepth, history, batch)
+        for (monthProvince, date), plantDataB in zip(monthList, results):
+            if history is not None:
+                # the plants whose status or sumBalance changed go to the change report
+                plantDataB, changes = plantDataB
+                if changes is not None and len(changes) > 0:
+                    if batch:
+                        changes.insert(0, "Province", monthProvince)
+                    changeSink.write(changes)
+            if batch:
+                plantDataB.insert(0, "Province", monthProvince)
+            with runLog.stage("export", month=f"{date}-{monthProvince}" if batch else date, rowsIn=len(plantDataB)) as record:
+                if sink is not None:
+                    sink.write(plantDataB)
+                if breakdown is not None:
+                    breakdown.add(plantDataB)
+                record["rowsOut"] = len(plantDataB)
+        with runLog.stage("export"):
+            if sink is not None:
+                sink.close()
+            if breakdown is not None:
+                breakdown.write(outputFileName("plantDataBreakdownMaster", outputFormat), outputFormat)
+            if history is not None:
+                changeSink.close()
+        loopRecord["rowsOut"] = sink.rows if sink is not None else None
+        #exportData(plantDataB)
+    runLog.write("PetrinexBalancing_OverTime")
+    return 
+
+
 def main():
     
     sMonth = int(input("Enter the start month: "))
     sYear = int(input("Enter the start year: "))
     eMonth = int(input("Enter the end month: "))
     eYear = int(input("Enter the end year: "))
-    csvOutputList = []
+    workers = int(input("Enter the number of worker processes (press enter to run one month at a time): ") or 1)
+    outputFormat = input("Enter the output format, csv or parquet (press enter for csv): ").lower() or "csv"
+    dateList = []
+    
+    # set the name path to the data
+    activityCodesCSV = "activityCodeFactors.csv"
+    exclusionRulesCSV = "exclusionRules.csv"
+    # set compactMemory to True to hold the identifier columns as categoricals,
+    # and reportMemory to True to print the memory used after each stage
+    compactMemory = False
+    reportMemory = False
+    # set profileRun to True to time each stage of each month and save the times, peak memory
+    # and row counts to a run log
+    profileRun = False
+    # set engine to "arrow" to sum the months with pyarrow, or "check" to run both engines
+    # and stop if they don't agree on which plants are unbalanced, see petrinex/engines.py
+    engine = "pandas"
+    # months read ahead on a background thread when running one month at a time, 0 to turn it off
+    prefetchMonths = 1
+    # set export to "breakdown" to write the unbalanced plants' balance by activity and product
+    # instead of all their rows, or "both" for both files
+    export = "rows"
+    # set maxPasses to stop the rebalance after that many passes when exclusionRules.csv has a Pass column
+    maxPasses = None
+    # set trackChanges to True to keep a history of each month in PetrinexHistory, a rerun then only
+    # balances the plants whose rows changed and reports the ones whose result changed
+    trackChanges = False
+    # set provinces to a list such as ["AB", "SK"] to balance the months of every province in one
+    # run, the output then has a Province column
+    provinces = None
     
     # now we need to loop through the months and years
     for y, m in monthYearIterator(sMonth, sYear, eMonth, eYear):
@@ -204,31 +420,15 @@ def main():
             date = str(y) + "-0" + str(m)
         else:
             date = str(y) + "-" + str(m)
-        # then we need to create a string that is the name of the csv file
-        plantDataCSV = "Vol_" + date + "-AB.CSV"
-        
-        # set the name path to the data
-        activityCodesCSV = "activityCodeFactors.csv"
-        
-        plantData = readData(plantDataCSV, activityCodesCSV)
-        plantDataPP = preprocessColumns(plantData)
-        plantDataB = balanceData(plantDataPP)
-        plantDataRB = rebalanceData(plantDataB)
-        plantDataB = balanceData(plantDataRB)
-        # variable to store csv file name to add to list
-        csvOutput = "plantDataUnbalanced" + date + ".csv"
-        plantDataB.to_csv(csvOutput, index=False)
-        
-        # csv list to store all the csv file names
-        csvOutputList.append(csvOutput)
-        
+        dateList.append(date)
     
-    # concat all the csv files into one master csv file
-    df_concat = pd.concat([pd.read_csv(f) for f in csvOutputList ], ignore_index=True)
-    df_concat.to_csv("plantDataUnbalancedMaster.csv", index=False)
-        #exportData(plantDataB)
+    run(dateList, activityCodesCSV, exclusionRulesCSV, workers, outputFormat,
+        compactMemory=compactMemory, reportMemory=reportMemory, profileRun=profileRun, engine=engine,
+        prefetchDepth=prefetchMonths, export=export, maxPasses=maxPasses, trackChanges=trackChanges,
+        provinces=provinces)
     return 
 
 
-main()
-    
+# only run main when the script is run directly, worker processes import this file
+if __name__ == "__main__":
+    main()
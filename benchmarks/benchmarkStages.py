@@ -0,0 +1,159 @@
+"""
+Stage benchmarks for the balancing scripts.
+
+Generates seeded synthetic Vol_YYYY-MM-AB.CSV months (see petrinex/synthetic.py) at 1x, 10x
+and 100x the size of a provincial month, then times readData, preprocessColumns,
+balanceData and rebalanceData from PetrinexBalancing_OverTime on each one. A 1x month is
+100,000 facilities, about 1.05 million rows and 180 MB of csv like an Alberta month.
+
+The months are generated a block at a time so any size can be written, but the stages
+read the whole month in: 1x takes about 3 GB, 10x about 30 GB and 100x (18 GB of csv)
+needs a machine with several hundred GB. Pick the sizes the machine can take with
+--scales, or a smaller --facilities for a quick run whose sizes are then scaled down.
+
+Every run is saved to benchmarks/results as json, along with a summary of the balancing
+results, and compared against the previous run (or the file given with --baseline) so
+a slower stage or a change in the results stands out.
+
+    python benchmarks/benchmarkStages.py --scales 1 10
+    python benchmarks/benchmarkStages.py --facilities 1000 --scales 1 10 100
+"""
+
+import argparse
+import contextlib
+import datetime as dt
+import glob
+import io
+import json
+import os
+import platform
+import sys
+import time
+
+repoFolder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repoFolder)
+
+import pandas as pd
+
+from petrinex.synthetic import writeMonth, writeActivityCodes, blockFacilities
+from petrinex.rules import readExclusionRules
+from petrinex.factors import readActivityFactors
+import PetrinexBalancing_OverTime as overTime
+
+resultsFolder = os.path.join(repoFolder, "benchmarks", "results")
+stages = ["readData", "preprocessColumns", "balanceData", "rebalanceData"]
+
+
+def prepareData(dataFolder, facilities, scale, seed):
+    # generated months are kept in dataFolder and reused when the same size and seed are asked for again
+    os.makedirs(dataFolder, exist_ok=True)
+    dataCSV = os.path.join(dataFolder, f"Vol_synthetic-{facilities * scale}-{seed}-AB.CSV")
+    if not os.path.exists(dataCSV):
+        print(f"Generating {facilities * scale} facilities into {dataCSV}")
+        writeMonth(dataCSV, facilities * scale, seed=seed)
+    activityCodesCSV = os.path.join(dataFolder, "activityCodeFactors.csv")
+    writeActivityCodes(activityCodesCSV)
+    return dataCSV, activityCodesCSV
+
+
+def runStages(dataCSV, activityFactors, exclusionRules):
+    # one pass of the month through every stage, returns the stage times and a summary of the results
+    timings = {}
+    # the scripts print as they go, that is kept out of the benchmark output
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        plantData = overTime.readData(dataCSV, activityFactors)
+        timings["readData"] = time.perf_counter() - start
+        rowsRead = len(plantData)
+
+        start = time.perf_counter()
+        plantDataPP = overTime.preprocessColumns(plantData)
+        timings["preprocessColumns"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        plantDataB = overTime.balanceData(plantDataPP)
+        timings["balanceData"] = time.perf_counter() - start
+        unbalanced = plantDataB["ReportingFacilityID"].nunique()
+
+        # the rebalance takes the excluded rows off the sums, the same as the over-time loop
+        start = time.perf_counter()
+        plantDataB = overTime.rebalance(plantDataB, exclusionRules)
+        timings["rebalanceData"] = time.perf_counter() - start
+
+    sums = plantDataB.drop_duplicates("ReportingFacilityID")["sumBalance"]
+    results = {
+        "rowsRead": rowsRead,
+        "rowsBalanced": len(plantDataPP),
+        "unbalanced": int(unbalanced),
+        "unbalancedAfterRebalance": int(len(sums)),
+        "sumBalance": round(float(sums.sum()), 2),
+    }
+    return timings, results
+
+
+def latestRun():
+    runs = sorted(glob.glob(os.path.join(resultsFolder, "benchmark-*.json")))
+    return runs[-1] if len(runs) > 0 else None
+
+
+def compareRuns(current, baseline, threshold):
+    # print the change in each stage time and flag anything slower than the threshold or with different results
+    print(f"\nCompared with {baseline['name']}:")
+    for scale, run in current["scales"].items():
+        previous = baseline["scales"].get(scale)
+        if previous is None:
+            print(f"  {scale}x: not in the baseline")
+            continue
+        for stage in stages + ["total"]:
+            change = run["seconds"][stage] / previous["seconds"][stage] - 1 if previous["seconds"][stage] > 0 else 0
+            flag = "  <-- slower" if change > threshold else ""
+            print(f"  {scale:>3}x {stage:18} {previous['seconds'][stage]:8.3f}s -> {run['seconds'][stage]:8.3f}s ({change:+.0%}){flag}")
+        if run["results"] != previous["results"]:
+            print(f"  {scale}x results changed: {previous['results']} -> {run['results']}  <-- check")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the balancing stages on synthetic Petrinex data")
+    parser.add_argument("--facilities", type=int, default=blockFacilities,
+                        help="facilities in a 1x month (default 100,000, a provincial month)")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100], help="month sizes to run, as multiples of --facilities")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per scale, the fastest is kept")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-folder", default=os.path.join(repoFolder, "benchmarks", "data"), help="where generated months are kept")
+    parser.add_argument("--baseline", help="results json to compare against (default: the previous run)")
+    parser.add_argument("--threshold", type=float, default=0.10, help="slowdown that is flagged, 0.10 = 10%%")
+    args = parser.parse_args()
+
+    baselineFile = args.baseline or latestRun()
+    with contextlib.redirect_stdout(io.StringIO()):
+        exclusionRules = readExclusionRules(os.path.join(repoFolder, "exclusionRules.csv"))
+
+    name = "benchmark-" + dt.datetime.now().strftime("%Y%m%d-%H%M%S")
+    current = {"name": name, "python": platform.python_version(), "pandas": pd.__version__,
+               "facilities": args.facilities, "seed": args.seed, "scales": {}}
+    for scale in args.scales:
+        dataCSV, activityCodesCSV = prepareData(args.data_folder, args.facilities, scale, args.seed)
+        # the factor table is read once per run by the scripts, so it is kept out of the readData time
+        with contextlib.redirect_stdout(io.StringIO()):
+            activityFactors = readActivityFactors(activityCodesCSV)
+        best = None
+        for _ in range(args.repeat):
+            timings, results = runStages(dataCSV, activityFactors, exclusionRules)
+            if best is None or sum(timings.values()) < sum(best.values()):
+                best = timings
+        best["total"] = sum(best.values())
+        current["scales"][str(scale)] = {"seconds": best, "results": results}
+        print(f"{scale}x ({results['rowsRead']} rows): " + ", ".join(f"{stage} {best[stage]:.3f}s" for stage in stages + ["total"]))
+
+    os.makedirs(resultsFolder, exist_ok=True)
+    with open(os.path.join(resultsFolder, name + ".json"), "w") as f:
+        json.dump(current, f, indent=2)
+    print(f"\nResults saved to {os.path.join(resultsFolder, name + '.json')}")
+
+    if baselineFile is not None:
+        with open(baselineFile) as f:
+            compareRuns(current, json.load(f), args.threshold)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Check the change detection on a republished month.
+
+Balances a synthetic month with a MonthHistory (petrinex/changes.py), edits the volume of
+one row of one facility and writes the month out again the way a republished Petrinex file
+would come, then balances it again. Stops with an error unless:
+
+- only the edited facility is picked up as changed and reported in the change report,
+- the sumBalance kept for the plants left unbalanced is the one the result carries,
+- the amended month comes out the same as balancing the new file from scratch,
+- a third run with the file untouched is loaded from the history with nothing reported,
+- editing a FLARE ENTGAS row the exclusion rules take out is picked up but not reported.
+
+    python checks/checkChanges.py
+"""
+
+import contextlib
+import io
+import os
+import sys
+import tempfile
+
+repoFolder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repoFolder)
+
+import numpy as np
+import pandas as pd
+
+from petrinex.synthetic import writeMonth, writeActivityCodes
+from petrinex.rules import readExclusionRules
+from petrinex.factors import readActivityFactors
+from petrinex.changes import MonthHistory
+from petrinex.files import volumeFileName
+import PetrinexBalancing_OverTime as overTime
+
+date = "2022-12"
+facilities = 200
+
+
+def republish(DataCSV, activity, product, facilities=None):
+    # adds 1000 to the volume of one of the activity's rows, from one of the facilities if they're
+    # given, returns the facility it belongs to
+    plantData = pd.read_csv(DataCSV, dtype=str, keep_default_na=False)
+    rows = (plantData["ActivityID"] == activity) & (plantData["ProductID"] == product) & (plantData["Volume"] != "")
+    if facilities is not None:
+        rows &= plantData["ReportingFacilityID"].isin(facilities)
+    rows = plantData.index[rows]
+    row = rows[len(rows) // 2]
+    volume = float(plantData.at[row, "Volume"].replace(",", ""))
+    plantData.at[row, "Volume"] = f"{volume + 1000:,.1f}"
+    plantData.to_csv(DataCSV, index=False)
+    # a new modified time even if the file was written within the same clock tick
+    stat = os.stat(DataCSV)
+    os.utime(DataCSV, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    return plantData.at[row, "ReportingFacilityID"]
+
+
+def changedHashes(hashes, newHashes):
+    return newHashes.index[newHashes.to_numpy() != hashes.reindex(newHashes.index).to_numpy()]
+
+
+def sortedRows(plantData):
+    return plantData.sort_values(list(plantData.columns)).reset_index(drop=True)
+
+
+def main():
+    with tempfile.TemporaryDirectory() as folder:
+        DataCSV = volumeFileName(date, "AB", folder)
+        activityCodesCSV = os.path.join(folder, "activityCodeFactors.csv")
+        writeMonth(DataCSV, facilities, date, seed=1)
+        writeActivityCodes(activityCodesCSV)
+        with contextlib.redirect_stdout(io.StringIO()):
+            # there's no rules file in the folder so the default rules are used
+            exclusionRules = readExclusionRules(os.path.join(folder, "exclusionRules.csv"))
+            activityFactors = readActivityFactors(activityCodesCSV)
+            history = MonthHistory("Check", activityCodesCSV, exclusionRules, folder=os.path.join(folder, "history"))
+            balance = lambda: overTime.updateMonth(date, history, activityFactors, exclusionRules, inputFolder=folder)[0]
+
+            _, changes = balance()
+            if changes is not None:
+                raise AssertionError("The first run of a month has nothing to compare against but reported changes")
+
+            edited = republish(DataCSV, "REC", "GAS")
+            hashes = history.load(date)["hashes"]
+            plantDataB, changes = balance()
+            fresh, _ = overTime.processMonth(date, activityFactors, exclusionRules, inputFolder=folder)
+            month = history.load(date)
+            changed = changedHashes(hashes, month["hashes"])
+
+            unchanged, noChanges = balance()
+
+            # a plant that only balances once the rules take its FLARE ENTGAS out, so the edited row
+            # comes out either way. in a plant that balances with it the edit changes the result
+            beforeRules = overTime.balanceData(overTime.preprocessColumns(overTime.readData(DataCSV, activityFactors)))
+            excluded = republish(DataCSV, "FLARE", "ENTGAS", set(beforeRules["ReportingFacilityID"]) - set(plantDataB["ReportingFacilityID"]))
+            _, excludedChanges = balance()
+            excludedChanged = changedHashes(month["hashes"], history.load(date)["hashes"])
+
+        if list(changed) != [edited]:
+            raise AssertionError(f"{edited} was edited but the hashes changed for {list(changed)}")
+        if changes is None or changes["ReportingFacilityID"].tolist() != [edited]:
+            reported = None if changes is None else changes["ReportingFacilityID"].tolist()
+            raise AssertionError(f"{edited} was edited but the change report has {reported}")
+        pd.testing.assert_frame_equal(sortedRows(plantDataB), sortedRows(fresh), check_exact=False, rtol=0, atol=1e-9)
+        unbalanced = plantDataB.drop_duplicates("ReportingFacilityID").set_index("ReportingFacilityID")["sumBalance"]
+        if not np.allclose(month["states"]["sumBalance"].reindex(unbalanced.index), unbalanced, rtol=0, atol=1e-9):
+            raise AssertionError("The history's sumBalance for the unbalanced plants isn't the one in the result")
+        if noChanges is not None or not unchanged.equals(plantDataB):
+            raise AssertionError("The untouched month wasn't loaded from the history as it was")
+        if list(excludedChanged) != [excluded] or len(excludedChanges) > 0:
+            raise AssertionError(f"Editing {excluded}'s excluded FLARE ENTGAS row changed the hashes for {list(excludedChanged)} "
+                                 f"and reported {excludedChanges['ReportingFacilityID'].tolist()}")
+        change = changes.iloc[0]
+        print(f"{edited} was reported as {change['change']}: {change['previousStatus']} {change['previousSumBalance']} -> "
+              f"{change['status']} {change['sumBalance']}")
+        print(f"The amended month has the same {len(plantDataB)} rows as balancing it from scratch")
+        print(f"Editing {excluded}'s excluded FLARE ENTGAS row wasn't reported")
+
+
+if __name__ == "__main__":
+    main()
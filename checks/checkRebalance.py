@@ -0,0 +1,101 @@
+"""
+Check the rebalance against dropping the rows and balancing again.
+
+petrinex/rebalance.py takes the rows the exclusion rules match off the unbalanced plants'
+sums instead of dropping them and running balanceData again. This builds a small month of
+plants that balance at different points of a two pass rule set, runs both ways with every
+pass and with the passes cut to one, and stops with an error if they don't leave the same
+plants unbalanced with the same rows and sums.
+
+    python checks/checkRebalance.py
+"""
+
+import contextlib
+import io
+import os
+import sys
+import tempfile
+
+repoFolder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repoFolder)
+
+import numpy as np
+import pandas as pd
+
+from petrinex.rules import readExclusionRules, limitPasses, exclusionMask
+from petrinex.rebalance import rebalance
+import PetrinexBalancing_OverTime as overTime
+
+factors = {"REC": 1, "DISP": -1, "FLARE": -1, "VENT": -1}
+
+# (plant, activity, product, volume), pass 1 takes out FLARE ENTGAS and pass 2 VENT GAS
+toyRows = [
+    # balanced before the rules
+    ("F1", "REC", "GAS", 100.0), ("F1", "DISP", "GAS", 100.0), ("F1", "FLARE", "ENTGAS", 0.01),
+    # balanced after pass 1
+    ("F2", "REC", "GAS", 100.0), ("F2", "DISP", "GAS", 100.0), ("F2", "FLARE", "ENTGAS", 10.0),
+    # balanced after pass 2
+    ("F3", "REC", "GAS", 100.0), ("F3", "DISP", "GAS", 100.0), ("F3", "FLARE", "ENTGAS", 4.0), ("F3", "VENT", "GAS", 6.0),
+    # still unbalanced after both passes
+    ("F4", "REC", "GAS", 100.0), ("F4", "DISP", "GAS", 80.0), ("F4", "FLARE", "ENTGAS", 5.0), ("F4", "VENT", "GAS", 5.0),
+    # only pass 2 has a row to take out
+    ("F5", "REC", "GAS", 100.0), ("F5", "DISP", "GAS", 100.0), ("F5", "VENT", "GAS", 7.0),
+    # balanced after pass 1, so its pass 2 row has to stay in
+    ("F6", "REC", "GAS", 101.03), ("F6", "DISP", "GAS", 100.0), ("F6", "FLARE", "ENTGAS", 3.0), ("F6", "VENT", "GAS", 1.0),
+    # decimals whose sums carry float noise
+    ("F7", "REC", "OIL", 0.1), ("F7", "REC", "OIL", 0.2), ("F7", "DISP", "OIL", 0.3), ("F7", "VENT", "GAS", 0.7),
+]
+
+
+def toyMonth():
+    plantData = pd.DataFrame(toyRows, columns=["ReportingFacilityID", "ActivityID", "ProductID", "Volume"])
+    return plantData.assign(Factor=plantData["ActivityID"].map(factors))
+
+
+def toyRules(folder):
+    rulesCSV = os.path.join(folder, "exclusionRules.csv")
+    pd.DataFrame({"ActivityID": ["FLARE", "VENT"], "ProductID": ["ENTGAS", "GAS"], "Pass": [1, 2]}).to_csv(rulesCSV, index=False)
+    return readExclusionRules(rulesCSV)
+
+
+def dropAndBalance(plantDataB, exclusionRules):
+    # the old way: each pass drops its rows from the plants still unbalanced and balances them again
+    for rulePass in sorted(exclusionRules["Pass"].unique()):
+        if len(plantDataB) == 0:
+            break
+        excluded = exclusionMask(plantDataB, exclusionRules[exclusionRules["Pass"] == rulePass])
+        plantDataB = overTime.balanceData(plantDataB[~excluded].drop(columns=["Balance", "sumBalance"]))
+    return plantDataB
+
+
+def compare(expected, actual, label):
+    keys = ["ReportingFacilityID", "ActivityID", "ProductID", "Volume"]
+    expected = expected.sort_values(keys).reset_index(drop=True)
+    actual = actual.sort_values(keys).reset_index(drop=True)
+    if set(expected["ReportingFacilityID"]) != set(actual["ReportingFacilityID"]):
+        raise AssertionError(f"{label}: dropping the rows leaves {sorted(set(expected['ReportingFacilityID']))} unbalanced, "
+                             f"the rebalance leaves {sorted(set(actual['ReportingFacilityID']))}")
+    pd.testing.assert_frame_equal(expected[keys], actual[keys], check_dtype=False)
+    # the sums are worked out in a different order so they can differ in the last digits
+    if not np.allclose(expected["sumBalance"], actual["sumBalance"], rtol=0, atol=1e-9):
+        raise AssertionError(f"{label}: the sumBalance values differ")
+    print(f"{label}: {sorted(set(actual['ReportingFacilityID']))} left unbalanced both ways")
+
+
+def main():
+    with tempfile.TemporaryDirectory() as folder, contextlib.redirect_stdout(io.StringIO()):
+        exclusionRules = toyRules(folder)
+    for maxPasses, unbalanced in [(None, {"F4"}), (1, {"F3", "F4", "F5", "F7"})]:
+        rules = limitPasses(exclusionRules, maxPasses)
+        with contextlib.redirect_stdout(io.StringIO()):
+            plantDataB = overTime.balanceData(toyMonth())
+            expected = dropAndBalance(plantDataB.copy(), rules)
+            actual = rebalance(plantDataB.copy(), rules)
+        label = "every pass" if maxPasses is None else f"{maxPasses} pass"
+        compare(expected, actual, label)
+        if set(actual["ReportingFacilityID"]) != unbalanced:
+            raise AssertionError(f"{label}: expected {sorted(unbalanced)} to be left unbalanced")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,7 @@
+"""
+Shared helpers for the Petrinex balancing scripts.
+
+The scripts in the top folder (PetrinexBalancing.py, PetrinexBalancing_OverTime.py and
+PetrinexBalancing_OT_By_Facility.py) import from here so the same logic isn't copied
+into each of them.
+"""
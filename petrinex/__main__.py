@@ -0,0 +1,3 @@
+from petrinex.cli import main
+
+main()
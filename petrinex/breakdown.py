@@ -0,0 +1,71 @@
+"""
+Per-facility breakdown of the unbalanced plants.
+
+The full export has every row of every unbalanced plant, and in the by-facility run every
+row of every plant, which makes for big files that are slow to open in Excel. The
+breakdown only has the plants outside ±0.05, one row per plant, month and ActivityID with
+the Balance summed into a column for each ProductID. That's enough to see where a plant's
+imbalance comes from, sumBalance is on every row so the total sits beside its parts.
+
+The products reported change from month to month, so BreakdownBuilder collects the months
+as they go past and writes them in one go at the end with a column for every product.
+The breakdown is a few rows per plant so holding it until then costs next to nothing.
+"""
+
+import pandas as pd
+
+from petrinex.output import ResultSink
+from petrinex.rebalance import outsideLimit
+
+# the columns down the side of the breakdown, the ones a frame doesn't have are skipped
+keyColumns = ["Province", "ProductionMonth", "ReportingFacilityID", "sumBalance", "ActivityID"]
+
+# the balances in the breakdown are rounded to this many decimals
+breakdownDecimals = 2
+
+
+# export is rows to write every row like before, breakdown to write the breakdown instead, or both
+def exportRows(export):
+    return export in ("rows", "both")
+
+
+def exportBreakdown(export):
+    return export in ("breakdown", "both")
+
+
+def facilityBreakdown(plantData):
+    # plantData is a frame from balanceData, the by-facility run labels each plant itself
+    if "Unbalanced/Balanced" in plantData.columns:
+        unbalanced = plantData["Unbalanced/Balanced"] == "Unbalanced"
+    else:
+        unbalanced = outsideLimit(plantData["sumBalance"])
+    plantData = plantData[unbalanced]
+    # sumBalance is rounded like the products are, the unrounded sum carries float noise into the keys
+    if "sumBalance" in plantData.columns:
+        plantData = plantData.assign(sumBalance=plantData["sumBalance"].round(breakdownDecimals))
+    keys = [column for column in keyColumns if column in plantData.columns]
+    breakdown = plantData.groupby(keys + ["ProductID"], observed=True, dropna=False)["Balance"].sum()
+    breakdown = breakdown.unstack("ProductID").round(breakdownDecimals)
+    breakdown.columns = breakdown.columns.astype(str)
+    return breakdown.reset_index()
+
+
+class BreakdownBuilder:
+
+    def __init__(self):
+        self.months = []
+
+    def add(self, plantData):
+        # plantData is a month from balanceData, None for a month with no data
+        if plantData is not None and len(plantData) > 0:
+            self.months.append(facilityBreakdown(plantData))
+
+    def write(self, fileName, outputFormat="csv"):
+        # the keys first and then a column for every product seen in any month, blank where a
+        # plant had nothing for that activity and product
+        breakdown = pd.concat(self.months, ignore_index=True) if len(self.months) > 0 else pd.DataFrame()
+        keys = [column for column in keyColumns if column in breakdown.columns]
+        products = sorted(column for column in breakdown.columns if column not in keys)
+        sink = ResultSink(fileName, outputFormat)
+        sink.write(breakdown[keys + products])
+        sink.close()
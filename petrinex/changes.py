@@ -0,0 +1,126 @@
+"""
+Change detection for republished months.
+
+Petrinex republishes past months when operators amend their reports, and the only way to
+pick the amendments up used to be balancing the month again from scratch. MonthHistory
+keeps what the over-time run needs to avoid that in the PetrinexHistory folder, one file
+per month: the size and modified time of the month's file, a hash of each facility's
+rows, each facility's sumBalance after the exclusion rules and whether it ended up
+balanced, and the month's result.
+
+A month whose file hasn't changed is loaded from the history without being read. A
+republished month is read and hashed again, and only the facilities whose hash changed,
+appeared or went away are balanced again, along with the ones left unbalanced last time
+so the month's rows come out in the same order as a full run. changeReport lists the
+facilities whose status or sumBalance changed with their old and new values.
+
+A facility's hash is the sum of its row hashes so it doesn't depend on the order the rows
+are in. The history is keyed on the activity code factors and the exclusion rules like
+the result store, a change to either balances every month again.
+
+The sumBalance kept and compared is the one the plant ends up with, after the exclusion
+passes took their rows off it, so it's the same sumBalance the result carries for the
+plants left unbalanced. An amendment to a row the rules take out of a plant doesn't show
+up as a change.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from petrinex.store import fileHash, fileFingerprint
+
+# folder (in the working folder) the month histories are kept in
+historyFolder = "PetrinexHistory"
+# bump when what a month's history holds changes so the months are balanced again
+historyVersion = 2
+
+# sumBalance is compared at the two decimals it is reported to, finer differences are float noise
+sumDecimals = 2
+
+
+def facilityHashes(plantData):
+    # one hash per facility, the row hashes wrap around when summed as uint64
+    rowHashes = pd.util.hash_pandas_object(plantData, index=False)
+    return rowHashes.groupby(np.asarray(plantData["ReportingFacilityID"], dtype=object)).sum()
+
+
+def facilityStates(plantData, plantDataB, rebalancedSums):
+    # each facility's sumBalance after the exclusion rules and whether it is still unbalanced. plantData is
+    # the month from preprocessColumns, plantDataB the rows of the plants left unbalanced and rebalancedSums
+    # the sums rebalance left the plants balanceData found unbalanced with, the rest balanced without the rules
+    balance = plantData["Volume"] * plantData["Factor"]
+    sums = balance.groupby(np.asarray(plantData["ReportingFacilityID"], dtype=object)).sum()
+    sums.update(rebalancedSums)
+    unbalanced = sums.index.isin(np.asarray(plantDataB["ReportingFacilityID"], dtype=object))
+    return pd.DataFrame({"sumBalance": sums, "status": np.where(unbalanced, "Unbalanced", "Balanced")})
+
+
+def changedFacilities(previous, hashes):
+    # the facilities that are new, gone or whose rows changed since the previous version of the month
+    previousHashes = previous["hashes"]
+    changed = hashes.index[hashes.to_numpy() != previousHashes.reindex(hashes.index, fill_value=0).to_numpy()]
+    removed = previousHashes.index.difference(hashes.index)
+    return changed.append(removed)
+
+
+def changeReport(date, previousStates, states, facilities):
+    # the facilities out of those given whose status or sumBalance changed between the two versions
+    old = previousStates.reindex(facilities)
+    new = states.reindex(facilities)
+    differs = (old["status"] != new["status"]) | (old["sumBalance"].round(sumDecimals) != new["sumBalance"].round(sumDecimals))
+    change = np.where(old["status"].isna(), "new", np.where(new["status"].isna(), "removed", "amended"))
+    report = pd.DataFrame({
+        "ProductionMonth": date,
+        "ReportingFacilityID": facilities,
+        "change": change,
+        "previousStatus": old["status"].fillna("").to_numpy(),
+        "status": new["status"].fillna("").to_numpy(),
+        "previousSumBalance": old["sumBalance"].round(sumDecimals).to_numpy(),
+        "sumBalance": new["sumBalance"].round(sumDecimals).to_numpy(),
+    })[differs.to_numpy()]
+    return report.sort_values("ReportingFacilityID").reset_index(drop=True)
+
+
+class MonthHistory:
+
+    def __init__(self, name, activityCodesCSV, exclusionRules, folder=historyFolder):
+        self.name = name
+        self.folder = folder
+        # what every month depends on besides its own file, the passes change the rebalance so they're in it too
+        self.key = {
+            "version": historyVersion,
+            "activityCodes": fileHash(activityCodesCSV),
+            "exclusionRules": sorted(map(list, zip(exclusionRules["ActivityID"], exclusionRules["ProductID"],
+                                                   exclusionRules["Pass"].astype(int)))),
+        }
+        self.keyHash = hashlib.sha256(json.dumps(self.key, sort_keys=True).encode()).hexdigest()
+        os.makedirs(folder, exist_ok=True)
+
+    def path(self, date, province="AB"):
+        # the Alberta months keep the names they had before other provinces were balanced
+        month = date if province == "AB" else f"{date}-{province}"
+        return os.path.join(self.folder, f"{self.name}_{month}.pkl")
+
+    def load(self, date, province="AB"):
+        # the month as it was last balanced, None if it never was or the key has changed since
+        path = self.path(date, province)
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            month = pickle.load(f)
+        return month if month["key"] == self.keyHash else None
+
+    def isCurrent(self, month, DataCSV):
+        return month is not None and month["source"] == fileFingerprint(DataCSV)
+
+    def save(self, date, DataCSV, hashes, states, result, province="AB"):
+        path = self.path(date, province)
+        month = {"key": self.keyHash, "source": fileFingerprint(DataCSV), "hashes": hashes, "states": states, "result": result}
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump(month, f)
+        os.replace(path + ".tmp", path)
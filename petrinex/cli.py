@@ -0,0 +1,206 @@
+"""
+Command line for the balancing scripts, so they can run in batch jobs without the prompts.
+
+    python -m petrinex file --month 2022-12
+    python -m petrinex file --month 2022-12 --workers 8
+    python -m petrinex overtime --start 2016-01 --end 2017-06 --workers 4 --format parquet
+    python -m petrinex overtime --start 2022-01 --end 2022-12 --provinces AB SK --workers 4
+    python -m petrinex facility --facilities ABGP0000003 ABGP0000007 --input-dir /data/petrinex
+    python -m petrinex facility --facilities ABGP0000003 --input-dir /mnt/shared --cache-dir /scratch/PetrinexCache
+    python -m petrinex cube --update --start 2016-01 --end 2022-12
+    python -m petrinex cube --facilities ABGP0000003 --months 2016-01 2016-02
+    python -m petrinex cube --province SK --update --start 2022-01 --end 2022-12
+    python -m petrinex serve --memory-mb 4096
+
+Each command calls the run function of its script (PetrinexBalancing.py,
+PetrinexBalancing_OverTime.py and PetrinexBalancing_OT_By_Facility.py). The scripts, and
+pandas with them, are only imported once the arguments are parsed so --help and argument
+errors come back straight away.
+"""
+
+import argparse
+import datetime as dt
+import importlib
+import os
+import sys
+
+# the scripts sit in the folder above the package
+repoFolder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+scripts = {"file": "PetrinexBalancing", "overtime": "PetrinexBalancing_OverTime",
+           "facility": "PetrinexBalancing_OT_By_Facility"}
+
+
+def loadScript(command):
+    if repoFolder not in sys.path:
+        sys.path.insert(0, repoFolder)
+    return importlib.import_module(scripts[command])
+
+
+def yearMonth(value):
+    # YYYY-MM from the command line as a (month, year) pair
+    try:
+        date = dt.datetime.strptime(value, "%Y-%m")
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} isn't a month, use YYYY-MM")
+    return date.month, date.year
+
+
+def latestMonth():
+    # the over-time by facility script runs up to two months back to deal with reporting lag
+    now = dt.datetime.now()
+    months = now.year * 12 + now.month - 1 - 2
+    return months % 12 + 1, months // 12
+
+
+def buildParser():
+    parser = argparse.ArgumentParser(prog="python -m petrinex", description="Balance Petrinex volumetric data")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    # options every command takes
+    inputs = argparse.ArgumentParser(add_help=False)
+    inputs.add_argument("--province", default="AB", help="province in the Vol_YYYY-MM-<province>.CSV file names (default AB)")
+    inputs.add_argument("--input-dir", default="", help="folder the monthly files are in (default the working folder)")
+    inputs.add_argument("--activity-codes", default="activityCodeFactors.csv", help="activity code factors csv")
+    inputs.add_argument("--exclusion-rules", default="exclusionRules.csv", help="activity and product pairs left out of the balance")
+    # options the commands that run a script take
+    common = argparse.ArgumentParser(add_help=False, parents=[inputs])
+    common.add_argument("--format", choices=["csv", "parquet"], default="csv", help="output format (default csv)")
+    common.add_argument("--compact", action="store_true", help="hold the identifier columns as categoricals")
+    common.add_argument("--report-memory", action="store_true", help="print the memory used after each stage")
+    common.add_argument("--profile", action="store_true", help="save stage times, peak memory and row counts to a run log")
+    common.add_argument("--export", choices=["rows", "breakdown", "both"], default="rows",
+                        help="every row of the unbalanced plants (default), their balance by activity and product, or both")
+
+    fileCommand = commands.add_parser("file", parents=[common], help="balance a single month (PetrinexBalancing.py)")
+    fileCommand.add_argument("--month", type=yearMonth, help="month to balance as YYYY-MM, read from the Vol_ file")
+    fileCommand.add_argument("--file", help="file to balance instead of a Vol_ month (default ABPlantDataDec22.CSV)")
+    fileCommand.add_argument("--max-passes", type=int, help="stop the rebalance after this many exclusion rule passes")
+    fileCommand.add_argument("--workers", type=int, default=1,
+                             help="worker processes that balance the month in facility shards (default 1, no shards)")
+
+    overTime = commands.add_parser("overtime", parents=[common], help="balance a range of months (PetrinexBalancing_OverTime.py)")
+    overTime.add_argument("--start", type=yearMonth, required=True, help="first month as YYYY-MM")
+    overTime.add_argument("--end", type=yearMonth, required=True, help="last month as YYYY-MM")
+    overTime.add_argument("--workers", type=int, default=1, help="worker processes (default 1, one month at a time)")
+    overTime.add_argument("--prefetch", type=int, default=1, help="months read ahead while one month at a time runs, 0 to turn off (default 1)")
+    overTime.add_argument("--engine", choices=["pandas", "arrow", "check"], default="pandas",
+                          help="pandas (default), arrow, or check to run both and compare the unbalanced plants")
+    overTime.add_argument("--max-passes", type=int, help="stop the rebalance after this many exclusion rule passes")
+    overTime.add_argument("--track-changes", action="store_true",
+                          help="only balance the plants whose rows changed since the last run and report the ones whose result changed")
+    overTime.add_argument("--provinces", nargs="+",
+                          help="provinces to balance together in one run instead of --province, the output gets a Province column")
+
+    facility = commands.add_parser("facility", parents=[common], help="balance facilities over time (PetrinexBalancing_OT_By_Facility.py)")
+    facility.add_argument("--facilities", nargs="+", required=True, help="facility IDs to balance")
+    facility.add_argument("--start", type=yearMonth, default=(1, 2015), help="first month as YYYY-MM (default 2015-01)")
+    facility.add_argument("--end", type=yearMonth, default=None, help="last month as YYYY-MM (default two months ago)")
+    facility.add_argument("--workers", type=int, default=1, help="worker processes (default 1, one month at a time)")
+    facility.add_argument("--prefetch", type=int, default=1, help="months read ahead while one month at a time runs, 0 to turn off (default 1)")
+    facility.add_argument("--cache-dir", default="PetrinexCache",
+                          help="folder the columnar copies of the months are kept in (default PetrinexCache in the working folder)")
+    facility.add_argument("--no-store", action="store_true", help="balance every month again instead of loading stored results")
+    facility.add_argument("--panel", choices=["facility", "product"],
+                          help="save the facility by month sums as a NumPy panel, split by product with 'product'")
+
+    cube = commands.add_parser("cube", parents=[inputs], help="query the balance cube, or add months to it (petrinex/cube.py)")
+    cube.add_argument("--update", action="store_true",
+                      help="sum the new and changed months from --start to --end into the cube before querying it")
+    cube.add_argument("--start", type=yearMonth, help="first month to add as YYYY-MM, with --update")
+    cube.add_argument("--end", type=yearMonth, help="last month to add as YYYY-MM, with --update")
+    cube.add_argument("--workers", type=int, default=1, help="worker processes for the months that need summing (default 1)")
+    cube.add_argument("--facilities", nargs="+", help="facility IDs to print from the cube")
+    cube.add_argument("--months", nargs="+", help="months to print as YYYY-MM (default all of them)")
+    cube.add_argument("--products", nargs="+", help="products to print (default all of them)")
+
+    service = commands.add_parser("serve", parents=[inputs], help="answer by-facility balance queries over HTTP on localhost (petrinex/service.py)")
+    service.add_argument("--port", type=int, default=8765, help="port on 127.0.0.1 to listen on (default 8765)")
+    service.add_argument("--cache-dir", default="PetrinexCache",
+                         help="folder the columnar copies of the months are kept in (default PetrinexCache in the working folder)")
+    service.add_argument("--memory-mb", type=int, default=2048, help="memory the cached months can take up in MB (default 2048)")
+    return parser
+
+
+def queryCube(args):
+    # queries are answered from the cube as it is on disk, it's only added to with --update
+    import time
+    from petrinex.cube import buildCube, openCube, cubePaths
+    from petrinex.files import monthDates
+    from petrinex.rules import readExclusionRules
+
+    if args.update:
+        if args.start is None or args.end is None:
+            raise SystemExit("--update needs the --start and --end months to add to the cube")
+        cube = buildCube(monthDates(*args.start, *args.end), args.activity_codes, readExclusionRules(args.exclusion_rules),
+                         args.province, args.input_dir, workers=args.workers)
+    elif not all(os.path.exists(path) for path in cubePaths(args.province)):
+        raise SystemExit(f"There is no {args.province} balance cube yet, add months to it with --update --start YYYY-MM --end YYYY-MM")
+    else:
+        cube = openCube(args.province)
+    if args.facilities is not None:
+        start = time.perf_counter()
+        try:
+            balances = cube.frame([facilityID.upper() for facilityID in args.facilities], args.months, args.products)
+        except KeyError as error:
+            raise SystemExit(error.args[0])
+        elapsed = (time.perf_counter() - start) * 1000
+        print(balances.to_string(index=False))
+        print(f"\n{len(balances)} balances read from the cube in {elapsed:.1f} ms\n")
+
+
+def startService(args):
+    from petrinex.service import BalanceService, serve
+    from petrinex.factors import readActivityFactors
+    from petrinex.rules import readExclusionRules
+
+    service = BalanceService(loadScript("facility"), readActivityFactors(args.activity_codes),
+                             readExclusionRules(args.exclusion_rules), args.memory_mb, args.province, args.input_dir,
+                             args.cache_dir)
+    serve(service, args.port)
+
+
+def main(argv=None):
+    args = buildParser().parse_args(argv)
+    from petrinex.files import volumeFileName, monthDates
+    if args.command == "cube":
+        queryCube(args)
+        return
+    if args.command == "serve":
+        startService(args)
+        return
+    script = loadScript(args.command)
+    options = dict(outputFormat=args.format, compactMemory=args.compact, reportMemory=args.report_memory,
+                   profileRun=args.profile, export=args.export)
+
+    if args.command == "file":
+        if args.file is not None:
+            plantDataCSV = os.path.join(args.input_dir, args.file)
+        elif args.month is not None:
+            month, year = args.month
+            plantDataCSV = volumeFileName(f"{year}-{month:02d}", args.province, args.input_dir)
+        else:
+            plantDataCSV = os.path.join(args.input_dir, "ABPlantDataDec22.CSV")
+        script.run(plantDataCSV, args.activity_codes, args.exclusion_rules, maxPasses=args.max_passes,
+                   workers=args.workers, **options)
+        return
+
+    start = args.start
+    end = args.end if args.end is not None else latestMonth()
+    dateList = monthDates(*start, *end)
+    if len(dateList) == 0:
+        raise SystemExit("The end month is before the start month")
+    if args.command == "overtime":
+        script.run(dateList, args.activity_codes, args.exclusion_rules, args.workers,
+                   province=args.province, inputFolder=args.input_dir, engine=args.engine,
+                   prefetchDepth=args.prefetch, maxPasses=args.max_passes, trackChanges=args.track_changes,
+                   provinces=args.provinces, **options)
+    else:
+        facilityList = list(dict.fromkeys(facilityID.upper() for facilityID in args.facilities))
+        script.run(dateList, facilityList, args.activity_codes, args.exclusion_rules, args.workers,
+                   province=args.province, inputFolder=args.input_dir, useResultStore=not args.no_store,
+                   panel=args.panel, prefetchDepth=args.prefetch, cacheFolder=args.cache_dir, **options)
+
+
+if __name__ == "__main__":
+    main()
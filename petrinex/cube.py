@@ -0,0 +1,225 @@
+"""
+Memory-mapped balance cube.
+
+Every facility's balance total for every month and product is kept on disk in the
+PetrinexCube folder as one facilities x months x products .npy array, with a json index
+of the labels beside it. Each province has its own cube and index, so balancing SK months
+never touches Alberta's cube. The totals are Volume x Factor with the exclusion rules and SAND
+left out, the same sums the balancing scripts check against ±0.05. Cells for a product
+a facility didn't report that month are NaN.
+
+openCube maps the array read-only, so a query only pages in the slice it asks for and
+comes back in milliseconds however many months are in the cube:
+
+    cube = openCube("AB")
+    cube.select(facilities=["ABGP0000003"], months=["2016-01", "2016-02"])
+
+buildCube only reads the months that are new or whose file changed since the cube was
+built, and only ever adds months to the cube or replaces them. Months outside the ones
+it's given, or whose file has since been deleted, stay in the cube as they were. Changed
+months with no new facilities or products are written into the cube in place. Otherwise
+a new cube is laid out and the other months are copied across from the old one rather
+than read again.
+"""
+
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+from petrinex.rules import exclusionMask
+from petrinex.volume import parseVolume
+from petrinex.store import fileHash, fileFingerprint
+from petrinex.files import volumeFileName, csvSource
+from petrinex.factors import readActivityFactors, reportUnknown
+
+# folder (in the working folder) the cube and its index are kept in
+cubeFolder = "PetrinexCube"
+# bump when the way the totals are worked out changes so old cubes are rebuilt
+cubeVersion = 1
+
+
+def cubePaths(province="AB", folder=cubeFolder):
+    # the Alberta cube keeps the names it had before other provinces were balanced
+    name = "balanceCube" if province == "AB" else f"balanceCube-{province}"
+    return os.path.join(folder, name + ".npy"), os.path.join(folder, name + ".json")
+
+
+def monthTotals(DataCSV, activityFactors, exclusionRules):
+    # a month's balance summed by facility and product, only the four columns needed are read
+    with csvSource(DataCSV) as source:
+        plantData = pd.read_csv(source, usecols=["ReportingFacilityID", "ActivityID", "ProductID", "Volume"])
+    volume, masked, unparseable = parseVolume(plantData["Volume"])
+    factor = activityFactors.factorArray(plantData["ActivityID"])
+    if np.isnan(factor).any():
+        reportUnknown(plantData["ActivityID"].to_numpy()[np.isnan(factor)], f"left out of the cube for {os.path.basename(DataCSV)}")
+
+    # the same rows the balance leaves out: unknown activities, SAND and the exclusion rules
+    keep = ~np.isnan(factor) & (plantData["ProductID"] != "SAND").to_numpy()
+    keep &= ~exclusionMask(plantData, exclusionRules)
+    plantData = plantData.assign(Balance=volume * factor)[keep]
+    return plantData.groupby(["ReportingFacilityID", "ProductID"])["Balance"].sum()
+
+
+class BalanceCube:
+
+    def __init__(self, values, index):
+        # values is the facilities x months x products array, usually memory-mapped
+        self.values = values
+        self.index = index
+        self.facilities = index["facilities"]
+        self.months = index["months"]
+        self.products = index["products"]
+        self.facilityPosition = {facility: i for i, facility in enumerate(self.facilities)}
+        self.monthPosition = {month: i for i, month in enumerate(self.months)}
+        self.productPosition = {product: i for i, product in enumerate(self.products)}
+
+    def positions(self, labels, lookup):
+        # label list to array positions, None means all of them
+        if labels is None:
+            return np.arange(len(lookup))
+        missing = [label for label in labels if label not in lookup]
+        if len(missing) > 0:
+            raise KeyError(f"{missing} are not in the balance cube")
+        return np.array([lookup[label] for label in labels], dtype=np.intp)
+
+    def select(self, facilities=None, months=None, products=None):
+        # the facilities x months x products block asked for, as an in-memory array
+        return self.values[np.ix_(self.positions(facilities, self.facilityPosition),
+                                  self.positions(months, self.monthPosition),
+                                  self.positions(products, self.productPosition))]
+
+    def totals(self, facilities=None, months=None):
+        # facilities x months balance over every product, NaN where a facility didn't report
+        block = self.select(facilities, months)
+        reported = ~np.isnan(block).all(axis=2)
+        return np.where(reported, np.nansum(block, axis=2), np.nan)
+
+    def frame(self, facilities=None, months=None, products=None):
+        # the block asked for as rows of ReportingFacilityID, ProductionMonth, ProductID and Balance
+        facilities = self.facilities if facilities is None else list(facilities)
+        months = self.months if months is None else list(months)
+        products = self.products if products is None else list(products)
+        block = self.select(facilities, months, products)
+        f, m, p = np.nonzero(~np.isnan(block))
+        return pd.DataFrame({
+            "ReportingFacilityID": np.asarray(facilities, dtype=object)[f],
+            "ProductionMonth": np.asarray(months, dtype=object)[m],
+            "ProductID": np.asarray(products, dtype=object)[p],
+            "Balance": block[f, m, p],
+        })
+
+
+def openCube(province="AB", folder=cubeFolder):
+    valuesPath, indexPath = cubePaths(province, folder)
+    with open(indexPath) as f:
+        index = json.load(f)
+    if index.get("province", "AB") != province:
+        raise ValueError(f"{indexPath} holds the {index['province']} balance cube, not {province}")
+    return BalanceCube(np.load(valuesPath, mmap_mode="r"), index)
+
+
+def cubeKey(activityCodesCSV, exclusionRules):
+    # what every month of the cube depends on besides its own file
+    return {
+        "version": cubeVersion,
+        "activityCodes": fileHash(activityCodesCSV),
+        "exclusionRules": sorted(map(list, zip(exclusionRules["ActivityID"], exclusionRules["ProductID"]))),
+    }
+
+
+def writeIndex(indexPath, index):
+    with open(indexPath + ".tmp", "w") as f:
+        json.dump(index, f)
+    os.replace(indexPath + ".tmp", indexPath)
+
+
+def buildCube(dateList, activityCodesCSV, exclusionRules, province="AB", inputFolder="", folder=cubeFolder, workers=1):
+    # adds the months in dateList that are new or changed to the cube and returns it opened read-only,
+    # the months already in the cube are kept whether or not they're in dateList or still have a file
+    os.makedirs(folder, exist_ok=True)
+    valuesPath, indexPath = cubePaths(province, folder)
+    files = {date: volumeFileName(date, province, inputFolder) for date in dateList}
+    files = {date: path for date, path in files.items() if os.path.exists(path)}
+    key = cubeKey(activityCodesCSV, exclusionRules)
+
+    # the cube already on disk, if it was built from the same activity codes and rules
+    old = None
+    if os.path.exists(valuesPath) and os.path.exists(indexPath):
+        old = openCube(province, folder)
+        if old.index["key"] != key:
+            # the stored months only go if every one of them can be summed again with the new codes and rules
+            lost = [date for date in old.months if date not in files]
+            if len(lost) > 0:
+                raise ValueError(f"The balance cube in {folder} was built with other activity codes or exclusion rules "
+                                 f"and {len(lost)} of its months have no file to sum again from, move it aside to build a new one")
+            print("The activity codes or exclusion rules have changed, the balance cube is built again\n")
+            old = None
+    if old is None and len(files) == 0:
+        raise FileNotFoundError(f"There are no month files to build the balance cube from in {inputFolder or 'the working folder'}")
+    sources = dict(old.index["sources"]) if old is not None else {}
+    changed = [date for date in files if sources.get(date) != fileFingerprint(files[date])]
+    sources.update({date: fileFingerprint(files[date]) for date in changed})
+    months = sorted(set(old.months if old is not None else []).union(files))
+    sameMonths = old is not None and old.months == months
+    if len(changed) == 0 and sameMonths:
+        print(f"The {province} balance cube is up to date, it has {len(months)} months\n")
+        return old
+
+    print(f"Summing {len(changed)} months into the balance cube\n")
+    month = partial(monthTotals, activityFactors=readActivityFactors(activityCodesCSV), exclusionRules=exclusionRules)
+    if workers <= 1:
+        totals = dict(zip(changed, map(month, [files[date] for date in changed])))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            totals = dict(zip(changed, executor.map(month, [files[date] for date in changed])))
+    newFacilities = set().union(*(monthTotal.index.get_level_values(0) for monthTotal in totals.values()))
+    newProducts = set().union(*(monthTotal.index.get_level_values(1) for monthTotal in totals.values()))
+
+    # changed months that only bring facilities and products the cube already has are written in place
+    if sameMonths and newFacilities <= set(old.facilities) and newProducts <= set(old.products):
+        index = dict(old.index, sources=sources)
+        old = None
+        cube = BalanceCube(np.load(valuesPath, mmap_mode="r+"), index)
+        for date, monthTotal in totals.items():
+            writeMonth(cube, date, monthTotal)
+        cube.values.flush()
+        cube = None
+        writeIndex(indexPath, index)
+        return openCube(province, folder)
+
+    # otherwise a new cube is laid out and the months that didn't change are copied across from the old one
+    facilities = sorted(newFacilities.union(old.facilities if old is not None else []))
+    products = sorted(newProducts.union(old.products if old is not None else []))
+    index = {"key": key, "province": province, "facilities": facilities, "months": months, "products": products, "sources": sources}
+    values = np.lib.format.open_memmap(valuesPath + ".tmp", mode="w+", dtype=np.float64,
+                                       shape=(len(facilities), len(months), len(products)))
+    values[:] = np.nan
+    cube = BalanceCube(values, index)
+    if old is not None:
+        facilityRows = cube.positions(old.facilities, cube.facilityPosition)[:, None]
+        productColumns = cube.positions(old.products, cube.productPosition)[None, :]
+        for date in old.months:
+            if date not in totals:
+                values[facilityRows, cube.monthPosition[date], productColumns] = old.values[:, old.monthPosition[date], :]
+    for date, monthTotal in totals.items():
+        writeMonth(cube, date, monthTotal)
+    values.flush()
+    # the old cube has to be let go before its file is replaced
+    old = cube = values = None
+    os.replace(valuesPath + ".tmp", valuesPath)
+    writeIndex(indexPath, index)
+    print(f"The {province} balance cube has {len(facilities)} facilities, {len(months)} months and {len(products)} products\n")
+    return openCube(province, folder)
+
+
+def writeMonth(cube, date, monthTotal):
+    # one month's totals into the cube, cells the month doesn't have are NaN
+    m = cube.monthPosition[date]
+    cube.values[:, m, :] = np.nan
+    f = np.array([cube.facilityPosition[facility] for facility in monthTotal.index.get_level_values(0)], dtype=np.intp)
+    p = np.array([cube.productPosition[product] for product in monthTotal.index.get_level_values(1)], dtype=np.intp)
+    cube.values[f, m, p] = monthTotal.to_numpy()
@@ -0,0 +1,186 @@
+"""
+Dataframe engines for the over-time balance.
+
+pandas is the reference engine: readData reads the whole month and the stages in the
+script balance every facility. The arrow engine does the heavy part of that with a lazy
+pyarrow dataset scan instead:
+- only the columns the balance needs are read (projection)
+- SAND rows and rows without a facility are dropped while the file is scanned (filter pushdown)
+- every facility's sum comes out of one multi-threaded group_by, and the rows the
+  exclusion rules match are taken off it the same way petrinex/rebalance.py does
+Only the facilities that are still unbalanced after the exclusion rules are then read in
+full and handed to the usual pandas stages, so the result has the same shape either way.
+
+The "check" engine runs the pandas stages on the whole month and the arrow sums beside
+them, and stops with an error if the two don't put the same facilities on the same side
+of the ±0.05 line.
+"""
+
+import zipfile
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+from petrinex.files import inferTypes, csvSource, csvMember
+from petrinex.factors import reportUnknown
+from petrinex.rebalance import subtractPasses, outsideLimit
+
+# the strings read_csv treats as missing, the arrow reads use the same list
+pandasNullValues = ["", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+                    "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null"]
+
+
+def csvColumns(DataCSV):
+    with csvSource(DataCSV) as source:
+        return list(pd.read_csv(source, nrows=0).columns)
+
+
+def scanCSV(DataCSV, columns, scanFilter):
+    # the columns asked for from the rows that pass scanFilter. every column is read as text, a column
+    # that looks numeric in the first block and isn't further down would stop the scan, Volume is
+    # parsed separately below
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+    import pyarrow.dataset as ds
+
+    convertOptions = pacsv.ConvertOptions(column_types={column: pa.string() for column in csvColumns(DataCSV)},
+                                          null_values=pandasNullValues, strings_can_be_null=True)
+    if DataCSV.lower().endswith(".csv"):
+        dataset = ds.dataset(DataCSV, format=ds.CsvFileFormat(convert_options=convertOptions))
+        return dataset.to_table(columns=columns, filter=scanFilter, use_threads=True)
+    
+    # zipped and compressed months are streamed a block at a time and filtered as they're decompressed
+    convertOptions.include_columns = columns
+    with compressedStream(DataCSV) as f:
+        reader = pacsv.open_csv(f, convert_options=convertOptions)
+        blocks = [pa.Table.from_batches([batch]).filter(scanFilter) for batch in reader]
+        return pa.concat_tables(blocks) if len(blocks) > 0 else reader.schema.empty_table()
+
+
+@contextmanager
+def compressedStream(DataCSV):
+    # the csv inside a zip, or a gzip or zstd csv, as a stream that decompresses as it is read
+    import pyarrow as pa
+
+    if DataCSV.lower().endswith(".zip"):
+        with zipfile.ZipFile(DataCSV) as archive, archive.open(csvMember(archive)) as f:
+            yield f
+    else:
+        with pa.input_stream(DataCSV, compression="detect") as f:
+            yield f
+
+
+def parseVolumeArrow(volume):
+    # the arrow version of petrinex/volume.py: thousands separators are dropped and
+    # anything that still isn't a number (masked ***, blanks) becomes 0
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    text = pc.utf8_trim_whitespace(pc.replace_substring(volume, ",", ""))
+    numeric = pc.fill_null(pc.match_substring_regex(text, r"^[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?$"), False)
+    return pc.cast(pc.if_else(numeric, text, "0"), pa.float64())
+
+
+def factorArray(activityID, activityFactors):
+    # the arrow version of ActivityFactors.factorArray, null where the activity isn't in the table
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    codes = pa.array(activityFactors.codes.astype(str).tolist(), pa.string())
+    factors = pa.array(activityFactors.factors.astype(np.float64))
+    return pc.take(factors, pc.index_in(activityID, value_set=codes))
+
+
+def exclusionMaskArrow(activityID, productID, rules):
+    # the arrow version of petrinex/rules.py exclusionMask
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    mask = pa.array(np.zeros(len(activityID), dtype=bool))
+    for activity, product in zip(rules["ActivityID"], rules["ProductID"]):
+        if activity != "" and product != "":
+            mask = pc.or_(mask, pc.and_(pc.equal(activityID, activity), pc.equal(productID, product)))
+    productOnly = rules.loc[rules["ActivityID"] == "", "ProductID"].tolist()
+    activityOnly = rules.loc[rules["ProductID"] == "", "ActivityID"].tolist()
+    mask = pc.or_(mask, pc.is_in(productID, value_set=pa.array(productOnly, pa.string())))
+    mask = pc.or_(mask, pc.is_in(activityID, value_set=pa.array(activityOnly, pa.string())))
+    return pc.fill_null(mask, False)
+
+
+def balanceSums(DataCSV, activityFactors, exclusionRules):
+    # every facility's sum before and after the exclusion rules, and which side of the line each falls
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+
+    product = ds.field("ProductID")
+    scanFilter = ((product != "SAND") | product.is_null()) & ds.field("ReportingFacilityID").is_valid()
+    table = scanCSV(DataCSV, ["ReportingFacilityID", "ActivityID", "ProductID", "Volume"], scanFilter)
+
+    factor = factorArray(table["ActivityID"], activityFactors)
+    if factor.null_count > 0:
+        reportUnknown(table["ActivityID"].filter(pc.is_null(factor)).to_pandas(), "left out of the balance")
+    table = pa.table({
+        "ReportingFacilityID": table["ReportingFacilityID"],
+        "ActivityID": table["ActivityID"],
+        "ProductID": table["ProductID"],
+        "balance": pc.multiply(parseVolumeArrow(table["Volume"]), factor),
+    }).filter(pc.is_valid(factor))
+    sums = table.group_by("ReportingFacilityID", use_threads=True).aggregate([("balance", "sum")]).to_pandas()
+    sums = sums.rename(columns={"balance_sum": "sumBalance"})
+
+    # the rows the exclusion rules match, tagged with the pass that takes them out, are taken
+    # off the sums the same way petrinex/rebalance.py does for the pandas engine
+    passes = np.sort(exclusionRules["Pass"].unique())
+    passPosition = pa.array(np.full(len(table), len(passes)))
+    for p in reversed(range(len(passes))):
+        excluded = exclusionMaskArrow(table["ActivityID"], table["ProductID"], exclusionRules[exclusionRules["Pass"] == passes[p]])
+        passPosition = pc.if_else(excluded, p, passPosition)
+    matched = table.append_column("passPosition", passPosition).filter(pc.less(passPosition, len(passes)))
+    facilityCodes = pd.Index(sums["ReportingFacilityID"]).get_indexer(matched["ReportingFacilityID"].to_pandas())
+    sumRebalanced, unbalanced, _ = subtractPasses(sums["sumBalance"].to_numpy(), facilityCodes,
+                                                          matched["balance"].to_numpy(), matched["passPosition"].to_numpy(),
+                                                          len(passes))
+
+    sums["sumRebalanced"] = sumRebalanced
+    sums["unbalancedFirst"] = outsideLimit(sums["sumBalance"])
+    # a plant is only balanced a second time if it was unbalanced the first time
+    sums["unbalanced"] = unbalanced
+    return sums[["ReportingFacilityID", "sumBalance", "sumRebalanced", "unbalancedFirst", "unbalanced"]]
+
+
+def readFacilities(DataCSV, activityFactors, facilityList, dropColumns=()):
+    # every row for the facilities asked for, laid out the way readData returns them: Volume
+    # parsed, the columns in dropColumns left out and Factor attached by an inner match on ActivityID
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+
+    columns = [column for column in csvColumns(DataCSV) if column not in dropColumns]
+    facilityFilter = ds.field("ReportingFacilityID").isin(pa.array(list(facilityList), pa.string()))
+    table = scanCSV(DataCSV, columns, facilityFilter)
+    table = table.set_column(table.schema.get_field_index("Volume"), "Volume", parseVolumeArrow(table["Volume"]))
+    table = table.append_column("Factor", factorArray(table["ActivityID"], activityFactors))
+    table = table.filter(pc.is_valid(table["Factor"]))
+
+    plantData = table.drop_columns(["Volume", "Factor"]).to_pandas()
+    plantData = inferTypes(plantData)
+    plantData["Volume"] = table["Volume"].to_numpy()
+    plantData = plantData[columns]
+    plantData["Factor"] = table["Factor"].to_numpy().astype(activityFactors.factors.dtype)
+    return plantData
+
+
+def compareEngines(date, sums, firstUnbalanced, finalUnbalanced):
+    # the pandas stages' unbalanced plants against the arrow sums, raises if they disagree
+    differences = []
+    for stage, pandasIDs, arrowIDs in [
+            ("before the exclusion rules", set(firstUnbalanced), set(sums.loc[sums["unbalancedFirst"], "ReportingFacilityID"])),
+            ("after the exclusion rules", set(finalUnbalanced), set(sums.loc[sums["unbalanced"], "ReportingFacilityID"]))]:
+        if pandasIDs != arrowIDs:
+            differences.append(f"{stage}: only pandas {sorted(pandasIDs - arrowIDs)}, only arrow {sorted(arrowIDs - pandasIDs)}")
+    if len(differences) > 0:
+        raise ValueError(f"The pandas and arrow engines classify {date} differently\n" + "\n".join(differences))
+    print(f"The pandas and arrow engines agree on all {len(sums)} plants for {date}\n")
+    return True
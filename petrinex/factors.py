@@ -0,0 +1,88 @@
+"""
+Activity code factors.
+
+activityCodeFactors.csv gives every ActivityID the factor its volume is multiplied by in
+the balance, 1 for volume into a plant and -1 for volume out. readActivityFactors reads
+and checks the table once at the start of a run and the months are handed the
+ActivityFactors it returns instead of each reading the file again.
+
+Each row's factor is found by looking its ActivityID up in the table's index, which gives
+a NumPy array of factors with NaN for the activities the table doesn't have. Those rows
+used to go without a word, the single month and over-time scripts lost them in the inner
+merge and the by-facility script gave them a factor of 0. They're still handled the same
+way but attachFactors prints which activities they were and how many rows each had.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+class ActivityFactors:
+
+    def __init__(self, activityCodes):
+        # activityCodes is the checked ActivityID and Factor table from readActivityFactors
+        self.table = activityCodes
+        self.codes = pd.Index(activityCodes["ActivityID"])
+        self.factors = activityCodes["Factor"].to_numpy()
+
+    def factorArray(self, activityID):
+        # each row's factor as a float array, NaN where the activity isn't in the table
+        # get_indexer gives -1 for codes that aren't in the table, which picks up the NaN on the end
+        if isinstance(activityID.dtype, pd.CategoricalDtype):
+            # categoricals are looked up once per category, missing values have code -1 as well
+            categoryFactors = np.append(self.factorArray(activityID.cat.categories), np.nan)
+            return categoryFactors[activityID.cat.codes.to_numpy()]
+        return np.append(self.factors.astype(np.float64), np.nan)[self.codes.get_indexer(activityID)]
+
+
+def readActivityFactors(activityCodesCSV):
+    # read everything as text so the checks below see the file as it was written
+    activityCodes = pd.read_csv(activityCodesCSV, dtype=str, keep_default_na=False)
+    missingColumns = [column for column in ["ActivityID", "Factor"] if column not in activityCodes.columns]
+    if len(missingColumns) > 0:
+        raise ValueError(f"{activityCodesCSV} has no {' or '.join(missingColumns)} column")
+    activityCodes = activityCodes[["ActivityID", "Factor"]].apply(lambda column: column.str.strip())
+
+    blankIDs = activityCodes["ActivityID"] == ""
+    if blankIDs.any():
+        raise ValueError(f"{activityCodesCSV} has {blankIDs.sum()} rows with no ActivityID")
+    factors = pd.to_numeric(activityCodes["Factor"], errors="coerce")
+    notNumbers = activityCodes.loc[factors.isna(), "ActivityID"].tolist()
+    if len(notNumbers) > 0:
+        raise ValueError(f"{activityCodesCSV} has factors that aren't numbers for {notNumbers}")
+    activityCodes["Factor"] = factors
+
+    # an activity listed twice with the same factor is harmless, with two different factors it's ambiguous
+    activityCodes = activityCodes.drop_duplicates().reset_index(drop=True)
+    conflicting = activityCodes.loc[activityCodes["ActivityID"].duplicated(), "ActivityID"].unique().tolist()
+    if len(conflicting) > 0:
+        raise ValueError(f"{activityCodesCSV} gives more than one factor for {conflicting}")
+    print(f"{len(activityCodes)} activity code factors have been read\n")
+    return ActivityFactors(activityCodes)
+
+
+def reportUnknown(activityID, action):
+    # prints the activities missing from the table with their row counts, most rows first
+    counts = pd.Series(activityID, dtype=object).fillna("NaN").value_counts()
+    listing = ", ".join(f"{activity} ({count} row{'s' if count != 1 else ''})" for activity, count in counts.items())
+    print(f"{counts.sum()} rows have activities that aren't in the activity code table and were {action}: {listing}\n")
+
+
+def attachFactors(plantData, activityFactors, unknownFactor=None):
+    # adds Factor as the last column. rows with an activity that isn't in the table are dropped,
+    # or given unknownFactor when it is set, and reported either way
+    factor = activityFactors.factorArray(plantData["ActivityID"])
+    unknown = np.isnan(factor)
+    if unknown.any():
+        activityID = plantData["ActivityID"].to_numpy()[unknown]
+        if unknownFactor is None:
+            reportUnknown(activityID, "left out of the balance")
+            plantData = plantData[~unknown]
+            factor = factor[~unknown]
+        else:
+            reportUnknown(activityID, f"given a factor of {unknownFactor}")
+            factor[unknown] = unknownFactor
+    # Factor keeps the table's type unless a filled in factor made it float
+    if unknownFactor is None or not unknown.any():
+        factor = factor.astype(activityFactors.factors.dtype)
+    return plantData.assign(Factor=factor).reset_index(drop=True)
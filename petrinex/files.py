@@ -0,0 +1,87 @@
+"""
+Where the monthly volumetric files are found and how they are opened.
+
+Petrinex names its monthly downloads Vol_YYYY-MM-<province>.CSV. The scripts used to look
+for them in the folder they were run from with AB written into the name, the province
+and the folder can now be passed in.
+
+The month doesn't have to be unpacked first, the .zip Petrinex downloads come in and
+gzip or zstd compressed csv files are read as they are. csvSource hands read_csv
+something it can stream, so the chunked reads decompress a chunk at a time and the
+facilities are filtered out as they go rather than after the whole file is unpacked.
+It's used as a context manager so a zip or zstd stream it opened is closed again once
+the month has been read.
+"""
+
+import os
+import zipfile
+from contextlib import contextmanager
+
+import pandas as pd
+
+# what a month's file can end in, a plain csv is used first if there is one
+volumeExtensions = [".CSV", ".csv", ".zip", ".ZIP", ".CSV.gz", ".csv.gz", ".CSV.zst", ".csv.zst"]
+
+
+def volumeFileName(date, province="AB", folder=""):
+    # the month's file, the .zip download or a compressed csv are used when there is no plain csv
+    stem = os.path.join(folder, f"Vol_{date}-{province}") if folder else f"Vol_{date}-{province}"
+    for extension in volumeExtensions:
+        if os.path.exists(stem + extension):
+            return stem + extension
+    return stem + ".CSV"
+
+
+def csvMember(archive):
+    # the csv inside a zip, Petrinex zips hold one but a readme or similar is skipped over
+    members = [name for name in archive.namelist() if name.lower().endswith(".csv")]
+    if len(members) == 0:
+        raise ValueError(f"There is no csv file in {archive.filename}")
+    return members[0]
+
+
+@contextmanager
+def csvSource(DataCSV):
+    # what read_csv is given for DataCSV, with csvSource(DataCSV) as source. pandas opens plain,
+    # gzip and single file zip csvs itself, a zip with more in it has its csv opened here, and
+    # zstd goes through pyarrow when the zstandard package isn't installed
+    lower = DataCSV.lower()
+    if lower.endswith(".zip"):
+        with zipfile.ZipFile(DataCSV) as archive:
+            if len(archive.namelist()) > 1:
+                with archive.open(csvMember(archive)) as member:
+                    yield member
+                return
+    if lower.endswith(".zst"):
+        try:
+            import zstandard  # noqa: F401
+        except ImportError:
+            import pyarrow as pa
+            with pa.input_stream(DataCSV, compression="zstd") as stream:
+                yield stream
+            return
+    yield DataCSV
+
+
+def monthDates(sMonth, sYear, eMonth, eYear):
+    # YYYY-MM strings for every month from the start month to the end month, both included
+    dateList = []
+    year, month = sYear, sMonth
+    while (year, month) <= (eYear, eMonth):
+        dateList.append(f"{year}-{month:02d}")
+        month += 1
+        if month == 13:
+            month = 1
+            year += 1
+    return dateList
+
+
+def inferTypes(plantData):
+    # the month is read as text so every chunk has the same shape, once the rows
+    # we want are kept convert the numeric columns the same way read_csv would have
+    for column in plantData.columns:
+        try:
+            plantData[column] = pd.to_numeric(plantData[column])
+        except (ValueError, TypeError):
+            pass
+    return plantData
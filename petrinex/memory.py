@@ -0,0 +1,53 @@
+"""
+Compact in-memory representation of the monthly volumetric data.
+
+A provincial month read straight from csv keeps every identifier as a Python string,
+compactFrame turns the repeated identifier columns into categoricals and downcasts the
+numeric columns where no value changes, and memoryUsage prints how much a frame takes
+up at each stage so the two modes can be compared.
+"""
+
+import numpy as np
+import pandas as pd
+
+# identifier columns that repeat across many rows, these are stored as categoricals
+categoryColumns = ['ProductionMonth', 'OperatorBAID', 'OperatorName', 'ReportingFacilityID',
+                   'ReportingFacilityProvinceState', 'ReportingFacilityType', 'ReportingFacilityIdentifier',
+                   'ReportingFacilityName', 'ReportingFacilitySubType', 'ReportingFacilitySubTypeDesc',
+                   'ReportingFacilityLocation', 'FacilityLegalSubdivision', 'FacilitySection',
+                   'FacilityTownship', 'FacilityRange', 'FacilityMeridian', 'SubmissionDate',
+                   'ActivityID', 'ProductID', 'FromToID', 'FromToIDProvinceState', 'FromToIDType',
+                   'FromToIDIdentifier', 'CCICode', 'ProrationProduct']
+
+
+def compactFrame(plantData):
+    for column in plantData.columns:
+        values = plantData[column]
+        if column in categoryColumns and values.dtype == object:
+            plantData[column] = values.astype("category")
+        elif pd.api.types.is_integer_dtype(values):
+            plantData[column] = pd.to_numeric(values, downcast="integer")
+        elif pd.api.types.is_float_dtype(values):
+            # only downcast floats when every value fits exactly so the balance sums don't change
+            small = values.astype("float32")
+            if np.array_equal(small.to_numpy(), values.to_numpy(), equal_nan=True):
+                plantData[column] = small
+    return plantData
+
+
+def fillMissing(plantData, value):
+    # fillna that also works on categorical columns, the fill value is added as a category first
+    filled = {}
+    for column in plantData.columns[plantData.isna().any().to_numpy()]:
+        values = plantData[column]
+        if isinstance(values.dtype, pd.CategoricalDtype) and value not in values.cat.categories:
+            values = values.cat.add_categories([value])
+        filled[column] = values.fillna(value)
+    return plantData.assign(**filled)
+
+
+def memoryUsage(plantData, stage):
+    # print the rows and memory used by the frame after a stage
+    megabytes = plantData.memory_usage(deep=True).sum() / 1024 ** 2
+    print(f"{stage}: {len(plantData)} rows, {megabytes:.1f} MB\n")
+    return megabytes
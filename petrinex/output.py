@@ -0,0 +1,100 @@
+"""
+Writing the over-time results.
+
+ResultSink appends each month's balanced frame straight to the final output file as it
+comes back, instead of writing a csv per month, reading them all back in and writing
+the master file again. The output can be a csv or a parquet file.
+
+A parquet file has one type per column for the whole file, and compact mode downcasts
+each month's numbers as far as that month's values allow. The numbers are widened back
+to 64 bits before they're written so a later month with bigger or finer values fits,
+and the identifier columns are always written as text. A later month that still
+doesn't fit the first month's types raises an error rather than being cast down.
+"""
+
+import numpy as np
+import pandas as pd
+
+from petrinex.memory import categoryColumns
+
+
+def outputFileName(baseName, outputFormat):
+    # e.g. PlantDataBalancedMaster + parquet -> PlantDataBalancedMaster.parquet
+    return f"{baseName}.{outputFormat}"
+
+
+class ResultSink:
+    
+    def __init__(self, fileName, outputFormat="csv"):
+        if outputFormat not in ("csv", "parquet"):
+            raise ValueError(f"Unknown output format {outputFormat}, use csv or parquet")
+        self.fileName = fileName
+        self.outputFormat = outputFormat
+        self.columns = None
+        self.writer = None
+        self.schema = None
+        self.rows = 0
+        self.months = 0
+    
+    def write(self, plantData):
+        # every month is written with the columns of the first month
+        if self.columns is None:
+            self.columns = list(plantData.columns)
+        else:
+            extra = [c for c in plantData.columns if c not in self.columns]
+            if len(extra) > 0:
+                print(f"Columns {extra} are not in the first month and were left out of {self.fileName}\n")
+            plantData = plantData.reindex(columns=self.columns)
+        
+        if self.outputFormat == "csv":
+            # the header is only written with the first month, after that rows are appended
+            plantData.to_csv(self.fileName, mode="w" if self.months == 0 else "a",
+                             header=self.months == 0, index=False)
+        else:
+            self.writeParquet(plantData)
+        self.rows += len(plantData)
+        self.months += 1
+    
+    def writeParquet(self, plantData):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        
+        table = pa.Table.from_pandas(parquetColumns(plantData), preserve_index=False)
+        
+        if self.writer is None:
+            # a column that is empty in the first month has no type yet, store it as text
+            self.schema = pa.schema([pa.field(f.name, pa.string()) if f.type == pa.null() else f for f in table.schema])
+            self.writer = pq.ParquetWriter(self.fileName, self.schema)
+        try:
+            # cast is safe, a value that would be truncated or overflow raises instead
+            table = table.cast(self.schema)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError) as error:
+            raise ValueError(f"Month {self.months + 1} doesn't fit the column types of the first month in {self.fileName}: {error}") from error
+        self.writer.write_table(table)
+    
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self.months == 0:
+            # nothing was ever written so there's no file, e.g. a run where no plant changed
+            print(f"There was nothing to write to {self.fileName}, it hasn't been created\n")
+            return
+        print(f"{self.rows} rows from {self.months} months have been written to {self.fileName}\n")
+
+
+def parquetColumns(plantData):
+    # every month with the same types whatever compact mode did to it: text, categorical and
+    # identifier columns as strings, integers as int64 and floats as float64
+    columns = {}
+    for column in plantData.columns:
+        values = plantData[column]
+        if column in categoryColumns or values.dtype == object or isinstance(values.dtype, pd.CategoricalDtype):
+            columns[column] = values.astype("string")
+        elif pd.api.types.is_bool_dtype(values):
+            continue
+        elif pd.api.types.is_integer_dtype(values):
+            columns[column] = values.astype("Int64" if pd.api.types.is_extension_array_dtype(values) else np.int64)
+        elif pd.api.types.is_float_dtype(values):
+            columns[column] = values.astype(np.float64)
+    return plantData.assign(**columns)
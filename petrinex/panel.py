@@ -0,0 +1,117 @@
+"""
+Facility by month imbalance panel.
+
+The over-time by facility run gives one frame per month. PanelBuilder collects each
+month's sums as the frames go past and ImbalancePanel holds them as one dense NumPy array,
+facilities down the rows and months across, with a third product axis when the panel is
+split by product. Months a facility didn't report are NaN.
+
+The analytics work on the whole array at once: the cumulative and rolling imbalance, how
+many months each facility was unbalanced and the first month it was. The panel is saved
+with its labels to a .npz file and loadPanel reads it back.
+"""
+
+import numpy as np
+import pandas as pd
+
+from petrinex.rebalance import outsideLimit
+
+
+class PanelBuilder:
+
+    def __init__(self, byProduct=False):
+        self.byProduct = byProduct
+        self.months = []
+        self.sums = []
+
+    def add(self, date, plantData):
+        # plantData is a month from balanceData, None for a month with no data
+        self.months.append(date)
+        if plantData is None or len(plantData) == 0:
+            return
+        if self.byProduct:
+            sums = plantData.groupby(["ReportingFacilityID", "ProductID"], sort=False)["Balance"].sum()
+        else:
+            sums = plantData.groupby("ReportingFacilityID", sort=False)["sumBalance"].first()
+        sums = sums.reset_index(name="value")
+        sums["month"] = len(self.months) - 1
+        self.sums.append(sums)
+
+    def panel(self):
+        months = np.array(self.months)
+        if len(self.sums) == 0:
+            return ImbalancePanel(np.full((0, len(months)), np.nan), np.array([], dtype=str), months)
+        sums = pd.concat(self.sums, ignore_index=True)
+        facilityCodes, facilities = pd.factorize(sums["ReportingFacilityID"], sort=True)
+        if not self.byProduct:
+            values = np.full((len(facilities), len(months)), np.nan)
+            values[facilityCodes, sums["month"].to_numpy()] = sums["value"].to_numpy()
+            return ImbalancePanel(values, facilities.to_numpy(dtype=str), months)
+        productCodes, products = pd.factorize(sums["ProductID"].astype(str), sort=True)
+        values = np.full((len(facilities), len(months), len(products)), np.nan)
+        values[facilityCodes, sums["month"].to_numpy(), productCodes] = sums["value"].to_numpy()
+        return ImbalancePanel(values, facilities.to_numpy(dtype=str), months, products.to_numpy(dtype=str))
+
+
+class ImbalancePanel:
+
+    def __init__(self, values, facilities, months, products=None):
+        # values is facilities x months, or facilities x months x products when products are given
+        self.values = values
+        self.facilities = np.asarray(facilities, dtype=str)
+        self.months = np.asarray(months, dtype=str)
+        self.products = None if products is None else np.asarray(products, dtype=str)
+
+    def totals(self):
+        # facilities x months sums, NaN for months a facility didn't report
+        if self.products is None:
+            return self.values
+        reported = ~np.isnan(self.values).all(axis=2)
+        return np.where(reported, np.nansum(self.values, axis=2), np.nan)
+
+    def unbalanced(self):
+        totals = self.totals()
+        return outsideLimit(totals)
+
+    def cumulativeImbalance(self):
+        # running total of each facility's imbalance, months it didn't report add nothing
+        return np.nancumsum(self.totals(), axis=1)
+
+    def rollingImbalance(self, window=12):
+        # imbalance over the last window months, shorter at the start of the range
+        cumulative = self.cumulativeImbalance()
+        rolling = cumulative.copy()
+        rolling[:, window:] -= cumulative[:, :-window]
+        return rolling
+
+    def monthsUnbalanced(self):
+        return self.unbalanced().sum(axis=1)
+
+    def firstUnbalanced(self):
+        # the first month each facility was unbalanced, blank if it never was
+        unbalanced = self.unbalanced()
+        first = self.months[unbalanced.argmax(axis=1)] if len(self.months) > 0 else np.array([], dtype=str)
+        return np.where(unbalanced.any(axis=1), first, "")
+
+    def summary(self, window=12):
+        # one row per facility with the analytics at the end of the range
+        atEnd = np.full(len(self.facilities), np.nan)
+        return pd.DataFrame({
+            "ReportingFacilityID": self.facilities,
+            "monthsReported": (~np.isnan(self.totals())).sum(axis=1),
+            "monthsUnbalanced": self.monthsUnbalanced(),
+            "firstUnbalanced": self.firstUnbalanced(),
+            "cumulativeImbalance": self.cumulativeImbalance()[:, -1] if len(self.months) > 0 else atEnd,
+            f"rollingImbalance{window}": self.rollingImbalance(window)[:, -1] if len(self.months) > 0 else atEnd,
+        }).round(2)
+
+    def save(self, fileName):
+        # the values and their labels in one .npz file
+        labels = {} if self.products is None else {"products": self.products}
+        np.savez_compressed(fileName, values=self.values, facilities=self.facilities, months=self.months, **labels)
+
+
+def loadPanel(fileName):
+    with np.load(fileName, allow_pickle=False) as saved:
+        products = saved["products"] if "products" in saved.files else None
+        return ImbalancePanel(saved["values"], saved["facilities"], saved["months"], products)
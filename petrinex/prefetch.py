@@ -0,0 +1,32 @@
+"""
+Reading the next month while this one is balanced.
+
+When the months run one at a time the reading and the balancing take turns, most of the
+read is waiting on the disk and parsing the csv. prefetch reads up to depth months ahead
+on a background thread so the next month is ready (or nearly) when this one is done.
+A thread rather than a process is used so the frame doesn't have to be pickled across,
+pandas lets go of the GIL for much of read_csv.
+
+At most depth months are read ahead of the one being balanced, so memory stays at
+depth + 1 months however long the run is.
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def prefetch(load, items, depth=1):
+    # yields (item, future) in order, future.result() is load(item)
+    # with depth 0 nothing is read ahead and the future is None
+    if depth <= 0:
+        for item in items:
+            yield item, None
+        return
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = deque()
+        for item in items:
+            pending.append((item, executor.submit(load, item)))
+            if len(pending) > depth:
+                yield pending.popleft()
+        while len(pending) > 0:
+            yield pending.popleft()
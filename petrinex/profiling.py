@@ -0,0 +1,169 @@
+"""
+Per-stage timing and memory instrumentation.
+
+A RunLog records, for every stage of every month, the wall time, the rows going in and
+out and the memory, and writes them to a json and a csv run log. When it isn't enabled
+stage() hands back a throwaway record and nothing is measured.
+
+The memory columns are the resident memory when the stage started and ended
+(rssStartMB, rssEndMB), the most it reached while the stage ran (stagePeakRSSMB) and the
+most the process had reached by the end of it (processPeakRSSMB). On Linux the
+process's high-water mark is reset through /proc/self/clear_refs at every stage's start
+and end, and folded into each stage that is still open, so a stage's peak is its own
+even when the months before it took more. Where the mark can't be reset stagePeakRSSMB is
+left empty, and without /proc only processPeakRSSMB is filled in.
+
+    runLog = RunLog(enabled=True)
+    with runLog.stage("readData", month="2022-12") as record:
+        plantData = readData(...)
+        record["rowsOut"] = len(plantData)
+    runLog.write("PetrinexBalancing")
+"""
+
+import datetime as dt
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # not available on windows, peak rss is left out there
+    resource = None
+
+logColumns = ["stage", "month", "seconds", "rssStartMB", "rssEndMB", "stagePeakRSSMB", "processPeakRSSMB",
+              "rowsIn", "rowsOut", "pid", "started"]
+
+# the records of the stages open in this process, across every RunLog in it, and whether the
+# high-water mark can be reset. the stages of a month nest inside the run's own stages
+openStages = []
+openStagesLock = threading.Lock()
+canResetPeak = None
+# the highest high-water mark read before a reset, which takes ru_maxrss back down with it
+processPeak = 0
+
+
+def forgetOpenStages():
+    # a forked worker starts with none of the parent's stages open and its own high-water mark
+    global openStagesLock, processPeak
+    openStages.clear()
+    openStagesLock = threading.Lock()
+    processPeak = 0
+    if canResetPeak:
+        resetPeak()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=forgetOpenStages)
+
+
+def processPeakRSS():
+    # peak resident memory of this process since it started in MB (ru_maxrss is KB on linux and bytes on mac)
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max(round(peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024, 1), processPeak)
+
+
+def memoryStatus():
+    # the current and high-water resident memory in MB from /proc, None for both where there's no /proc
+    try:
+        with open("/proc/self/status") as f:
+            status = dict(line.split(":", 1) for line in f if line.startswith(("VmRSS", "VmHWM")))
+    except OSError:
+        return None, None
+    return round(int(status["VmRSS"].split()[0]) / 1024, 1), round(int(status["VmHWM"].split()[0]) / 1024, 1)
+
+
+def resetPeak():
+    # writing 5 to clear_refs sets the high-water mark back to the current rss (Linux 4.0 and up)
+    global canResetPeak
+    if canResetPeak is False:
+        return False
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        canResetPeak = True
+    except OSError:
+        canResetPeak = False
+    return canResetPeak
+
+
+def foldPeak():
+    # the high-water mark since the last reset goes into every open stage and is reset, returns the rss now
+    # called with openStagesLock held
+    global processPeak
+    rss, highWater = memoryStatus()
+    if highWater is not None:
+        processPeak = max(processPeak, highWater)
+        for record in openStages:
+            record["stagePeakRSSMB"] = max(record["stagePeakRSSMB"] or 0, highWater)
+    if not resetPeak():
+        for record in openStages:
+            record["stagePeakRSSMB"] = None
+    return rss
+
+
+class RunLog:
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.records = []
+
+    @contextmanager
+    def stage(self, name, month=None, rowsIn=None):
+        # the caller fills in record["rowsOut"] (and rowsIn if it isn't known up front)
+        record = {"stage": name, "month": month, "rowsIn": rowsIn, "rowsOut": None}
+        if not self.enabled:
+            yield record
+            return
+        record["started"] = dt.datetime.now().isoformat(timespec="seconds")
+        record["pid"] = os.getpid()
+        with openStagesLock:
+            record["rssStartMB"] = foldPeak()
+            record["stagePeakRSSMB"] = record["rssStartMB"] if canResetPeak else None
+            openStages.append(record)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = round(time.perf_counter() - start, 4)
+            with openStagesLock:
+                record["rssEndMB"] = foldPeak()
+                del openStages[next(i for i, stage in enumerate(openStages) if stage is record)]
+            record["processPeakRSSMB"] = processPeakRSS()
+            self.records.append(record)
+
+    def extend(self, records):
+        # records measured in a worker process are handed back and added here
+        self.records.extend(records)
+
+    def write(self, name):
+        # writes <name>RunLog<timestamp>.json and .csv, returns the two file names
+        if not self.enabled:
+            return None
+        import pandas as pd
+
+        stamp = dt.datetime.now().strftime("%Y%m%d-%H%M%S")
+        jsonFile = f"{name}RunLog{stamp}.json"
+        csvFile = f"{name}RunLog{stamp}.csv"
+        with open(jsonFile, "w") as f:
+            json.dump(self.records, f, indent=2)
+        # stages without a row count would turn the counts into floats
+        runLogFrame = pd.DataFrame(self.records, columns=logColumns)
+        runLogFrame = runLogFrame.astype({"rowsIn": "Int64", "rowsOut": "Int64", "pid": "Int64"})
+        runLogFrame.to_csv(csvFile, index=False)
+        print(f"The run log has been saved as {jsonFile} and {csvFile}\n")
+        return jsonFile, csvFile
+
+
+def collectRecords(results, runLog=None):
+    # results are (result, records) pairs from processMonth, the records go into runLog
+    # and the results are passed on in order
+    for result, records in results:
+        if runLog is not None:
+            runLog.extend(records)
+        yield result
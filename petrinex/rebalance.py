@@ -0,0 +1,85 @@
+"""
+Rebalancing the unbalanced plants with the exclusion rules.
+
+The scripts used to drop the rows matching the exclusion rules and run balanceData again,
+summing every row that was left from scratch. Only the plants that lost rows can change,
+and only by the Balance of the rows they lost, so rebalance subtracts those rows from the
+plants' sums and checks just those plants against ±0.05 again.
+
+When exclusionRules.csv has a Pass column the rules are taken out a pass at a time, each
+pass only from the plants that are still unbalanced after the one before. It stops when
+every plant balances or the passes run out, limitPasses in petrinex/rules.py cuts the
+number of passes. The rows are matched to their pass once up front, after that each pass
+costs the rows it takes out rather than the size of the month.
+"""
+
+import numpy as np
+import pandas as pd
+
+from petrinex.rules import rulePasses
+
+# a plant is unbalanced when its sum is outside ±balanceLimit, the scripts and the
+# other modules all check against this one
+balanceLimit = 0.05
+
+
+def outsideLimit(sums):
+    return (sums > balanceLimit) | (sums < -balanceLimit)
+
+
+def subtractPasses(sums, facilityCodes, balance, passPosition, passCount, report=False):
+    # sums is every plant's sum before the rules. facilityCodes, balance and passPosition are the
+    # rows a rule matches: the plant's position in sums, the row's Balance and the pass (from 0)
+    # that takes it out. returns the sums after the passes, which plants are still unbalanced
+    # and how many passes were run
+    sums = sums.copy()
+    unbalanced = outsideLimit(sums)
+    countUnbalanced = int(unbalanced.sum())
+    order = np.argsort(passPosition, kind="stable")
+    bounds = np.searchsorted(passPosition[order], np.arange(passCount + 1))
+    passesRun = 0
+    for p in range(passCount):
+        if countUnbalanced == 0:
+            break
+        # only the rows of plants that are still unbalanced come out
+        rows = order[bounds[p]:bounds[p + 1]]
+        rows = rows[unbalanced[facilityCodes[rows]]]
+        np.subtract.at(sums, facilityCodes[rows], balance[rows])
+        touched = np.unique(facilityCodes[rows])
+        unbalanced[touched] = outsideLimit(sums[touched])
+        countUnbalanced -= len(touched) - int(unbalanced[touched].sum())
+        passesRun = p + 1
+        if report:
+            print(f"Exclusion pass {passesRun} took out {len(rows)} rows from {len(touched)} plants, "
+                  f"{countUnbalanced} plants are still unbalanced\n")
+    return sums, unbalanced, passesRun
+
+
+def rebalance(plantData, exclusionRules, plantSums=False):
+    # plantData is the rows balanceData kept for the unbalanced plants, with Balance and sumBalance.
+    # returns the rows of the plants still unbalanced after the exclusion passes, less the rows the
+    # passes took out, laid out the same as dropping the rows and running balanceData again would give.
+    # with plantSums every plant's sum after the passes comes back as well, by ReportingFacilityID
+    facilityCodes, facilityIDs = pd.factorize(plantData["ReportingFacilityID"])
+    sums = np.empty(len(facilityIDs))
+    sums[facilityCodes] = plantData["sumBalance"].to_numpy()
+
+    # the pass each row comes out in, len(passes) for the rows no rule matches
+    passes = np.sort(exclusionRules["Pass"].unique())
+    passPosition = np.searchsorted(passes, rulePasses(plantData, exclusionRules))
+    matched = np.flatnonzero(passPosition < len(passes))
+    balance = plantData["Balance"].to_numpy()
+    sums, unbalanced, passesRun = subtractPasses(sums, facilityCodes[matched], balance[matched],
+                                                 passPosition[matched], len(passes), report=True)
+
+    # the plants that are still unbalanced, without the rows the passes they went through took out
+    keep = unbalanced[facilityCodes] & (passPosition >= passesRun)
+    plantData = plantData[keep].reset_index(drop=True)
+    plantData["sumBalance"] = sums[facilityCodes[keep]]
+
+    stillUnbalanced = pd.DataFrame({"ReportingFacilityID": facilityIDs[unbalanced], "sumBalance": sums[unbalanced]})
+    print("There are " + str(len(stillUnbalanced)) + " plants that have not been properly balanced:\n")
+    print(stillUnbalanced.sort_values(by=["sumBalance"]))
+    if plantSums:
+        return plantData, pd.Series(sums, index=np.asarray(facilityIDs, dtype=object))
+    return plantData
@@ -0,0 +1,93 @@
+"""
+Exclusion rules for balancing.
+
+Each rule is an ActivityID and ProductID pair read from exclusionRules.csv, rows that
+match a rule are left out of the balance. Leaving ActivityID or ProductID blank matches
+any value, so a rule of ",SAND" takes out sand for every activity.
+
+All the rules are checked in one pass, the (ActivityID, ProductID) pairs are hashed and
+looked up in the rule set so 50 rules cost about the same as one.
+
+An optional Pass column splits the rules into rebalance passes: the pass 1 rules are
+taken out of every unbalanced plant, the pass 2 rules only out of the plants still
+unbalanced after that, and so on, see petrinex/rebalance.py. Without the column every
+rule is in pass 1.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+# used when there is no rules file in the folder, the same pairs the scripts used to hard code
+defaultRules = [("FLARE", "ENTGAS"), ("", "SAND")]
+
+
+def readExclusionRules(rulesCSV):
+    if not os.path.exists(rulesCSV):
+        print(f"{rulesCSV} was not found, using the default exclusion rules\n")
+        return pd.DataFrame([(activity, product, 1) for activity, product in defaultRules],
+                            columns=["ActivityID", "ProductID", "Pass"])
+    
+    # read everything as text so blanks stay as '' (the wildcard) rather than NaN
+    rules = pd.read_csv(rulesCSV, dtype=str, keep_default_na=False)
+    passes = rules["Pass"].str.strip() if "Pass" in rules.columns else pd.Series("1", index=rules.index)
+    rules = rules[["ActivityID", "ProductID"]].apply(lambda column: column.str.strip())
+    passes = pd.to_numeric(passes.replace("", "1"), errors="coerce")
+    if passes.isna().any() or (passes < 1).any() or (passes % 1 != 0).any():
+        raise ValueError(f"{rulesCSV} has Pass values that aren't whole numbers from 1 up")
+    rules["Pass"] = passes.astype(int)
+    
+    # a rule with both sides blank would take out every row
+    emptyRules = (rules["ActivityID"] == "") & (rules["ProductID"] == "")
+    if emptyRules.any():
+        print(f"Skipping {emptyRules.sum()} rules in {rulesCSV} with no ActivityID or ProductID\n")
+    # a rule listed in more than one pass takes effect in the first of them
+    rules = rules[~emptyRules].sort_values("Pass", kind="stable")
+    rules = rules.drop_duplicates(subset=["ActivityID", "ProductID"]).sort_index().reset_index(drop=True)
+    passCount = rules["Pass"].nunique()
+    print(f"{len(rules)} exclusion rules have been read" + (f" in {passCount} passes" if passCount > 1 else "") + "\n")
+    return rules
+
+
+def limitPasses(rules, maxPasses=None):
+    # only the rules in the first maxPasses passes, all of them when maxPasses is None
+    if maxPasses is None:
+        return rules
+    passes = sorted(rules["Pass"].unique())[:maxPasses]
+    return rules[rules["Pass"].isin(passes)].reset_index(drop=True)
+
+
+def exclusionMask(plantData, rules):
+    # returns a boolean array that is True for the rows that match any of the rules
+    activityID = plantData["ActivityID"]
+    productID = plantData["ProductID"]
+    
+    # rules with both an activity and a product, checked as pairs
+    pairRules = rules[(rules["ActivityID"] != "") & (rules["ProductID"] != "")]
+    pairs = list(zip(pairRules["ActivityID"], pairRules["ProductID"]))
+    mask = pd.MultiIndex.from_arrays([activityID, productID]).isin(pairs)
+    
+    # rules with a blank on one side match on the other column alone
+    mask |= productID.isin(rules.loc[rules["ActivityID"] == "", "ProductID"]).to_numpy()
+    mask |= activityID.isin(rules.loc[rules["ProductID"] == "", "ActivityID"]).to_numpy()
+    return mask
+
+
+def rulePasses(plantData, rules):
+    # the first pass with a rule matching each row, inf for the rows no rule matches
+    # like exclusionMask this is one lookup per kind of rule however many passes there are
+    activityID = plantData["ActivityID"]
+    productID = plantData["ProductID"]
+    rowPass = np.full(len(plantData), np.inf)
+    
+    pairRules = rules[(rules["ActivityID"] != "") & (rules["ProductID"] != "")]
+    pairs = pd.MultiIndex.from_arrays([pairRules["ActivityID"], pairRules["ProductID"]])
+    pairPasses = np.append(pairRules["Pass"].to_numpy(dtype=float), np.inf)
+    rowPass = np.minimum(rowPass, pairPasses[pairs.get_indexer(pd.MultiIndex.from_arrays([activityID, productID]))])
+    
+    for column, blank, other in [(productID, "ActivityID", "ProductID"), (activityID, "ProductID", "ActivityID")]:
+        oneSided = rules[rules[blank] == ""]
+        passes = oneSided.groupby(other)["Pass"].min()
+        columnPasses = passes.reindex(np.asarray(column, dtype=object)).to_numpy(dtype=float)
+        rowPass = np.minimum(rowPass, np.where(np.isnan(columnPasses), np.inf, columnPasses))
+    return rowPass
@@ -0,0 +1,221 @@
+"""
+Local balance query service.
+
+Running PetrinexBalancing_OT_By_Facility.py reads every month from disk again for each new
+set of facilities. serve keeps a small HTTP server running on localhost instead, with the
+months it has read held in memory already parsed and with their factors attached, so a
+query for facilities that have been asked about before (or any facilities in months that
+have) comes back in milliseconds:
+
+    python -m petrinex serve --memory-mb 4096
+    curl "http://127.0.0.1:8765/balance?facilities=ABGP0000003,ABGP0000007&start=2016-01&end=2016-12"
+    curl "http://127.0.0.1:8765/metrics"
+
+/balance answers with each facility's sumBalance and status for every month it reported,
+add rows=1 for the balanced rows as well. /metrics gives the cache hits, misses and
+evictions and the memory the cached months take up.
+
+MonthCache keeps the months in least recently used order and drops the oldest once the
+months held go over the memory budget. A month is cached under its file's size and
+modified time, so a republished file is read again. Each cached month is indexed by
+facility so a query only touches the rows of the facilities asked for. The server only
+listens on 127.0.0.1 and never needs the network.
+"""
+
+import contextlib
+import io
+import json
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+import pandas as pd
+
+from petrinex.files import volumeFileName, monthDates
+from petrinex.store import fileFingerprint
+
+# the service is only ever reachable from this machine
+serviceHost = "127.0.0.1"
+servicePort = 8765
+
+
+class CachedMonth:
+
+    def __init__(self, plantData):
+        # plantData is the whole month from the by-facility readData, kept in file order
+        self.plantData = plantData
+        facilityCodes, facilities = pd.factorize(plantData["ReportingFacilityID"])
+        self.facilities = pd.Index(facilities)
+        # each facility's rows are a slice of order, found through bounds
+        self.order = np.argsort(facilityCodes, kind="stable")
+        self.bounds = np.searchsorted(facilityCodes[self.order], np.arange(len(facilities) + 1))
+        self.size = int(plantData.memory_usage(deep=True).sum()) + self.order.nbytes + self.bounds.nbytes
+
+    def select(self, facilityList):
+        # the rows for the facilities asked for, in the order they are in the file
+        positions = [i for i in self.facilities.get_indexer(facilityList) if i >= 0]
+        rows = np.sort(np.concatenate([self.order[self.bounds[i]:self.bounds[i + 1]] for i in positions] + [np.array([], dtype=np.intp)]))
+        return self.plantData.take(rows).reset_index(drop=True)
+
+
+class MonthCache:
+
+    def __init__(self, load, budgetMB):
+        # load(DataCSV) reads a month for the cache
+        self.load = load
+        self.budget = budgetMB * 1024 ** 2
+        self.months = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.loadSeconds = 0.0
+
+    def get(self, DataCSV):
+        # the month from the cache, read and added to it on a miss
+        key = (DataCSV, tuple(fileFingerprint(DataCSV)))
+        if key in self.months:
+            self.hits += 1
+            self.months.move_to_end(key)
+            return self.months[key]
+        self.misses += 1
+        start = time.perf_counter()
+        month = CachedMonth(self.load(DataCSV))
+        self.loadSeconds += time.perf_counter() - start
+        self.months[key] = month
+        self.size += month.size
+        # the month just read is always kept, even when it is over the budget on its own
+        while self.size > self.budget and len(self.months) > 1:
+            _, oldest = self.months.popitem(last=False)
+            self.size -= oldest.size
+            self.evictions += 1
+        return month
+
+    def metrics(self):
+        requests = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": round(self.hits / requests, 3) if requests > 0 else None,
+            "evictions": self.evictions,
+            "monthsCached": len(self.months),
+            "cachedMB": round(self.size / 1024 ** 2, 1),
+            "budgetMB": round(self.budget / 1024 ** 2, 1),
+            "loadSeconds": round(self.loadSeconds, 3),
+        }
+
+
+class BalanceService:
+
+    def __init__(self, script, activityFactors, exclusionRules, budgetMB, province="AB", inputFolder="", cacheFolder=None):
+        # script is PetrinexBalancing_OT_By_Facility, its readData and balancing stages are used as they are
+        # cacheFolder is where its columnar copies of the months go, the script's own default when it's None
+        self.script = script
+        self.exclusionRules = exclusionRules
+        self.province = province
+        self.inputFolder = inputFolder
+        cacheFolder = script.cacheFolder if cacheFolder is None else cacheFolder
+        load = lambda DataCSV: script.readData(DataCSV, activityFactors, None, compact=True, cacheFolder=cacheFolder)
+        self.cache = MonthCache(load, budgetMB)
+        self.queries = 0
+        # one query at a time, the cache and the stages' printing aren't shared between threads
+        self.lock = threading.Lock()
+
+    def balance(self, facilityList, dateList, includeRows=False):
+        start = time.perf_counter()
+        summaries = []
+        rows = []
+        missing = []
+        with self.lock:
+            self.queries += 1
+            for date in dateList:
+                DataCSV = volumeFileName(date, self.province, self.inputFolder)
+                try:
+                    month = self.cache.get(DataCSV)
+                except FileNotFoundError:
+                    missing.append(date)
+                    continue
+                plantData = month.select(facilityList)
+                if len(plantData) == 0:
+                    continue
+                # the stages print as they go, that stays out of the service's output
+                with contextlib.redirect_stdout(io.StringIO()):
+                    plantDataB = self.script.balanceData(self.script.preprocessColumns(plantData, self.exclusionRules))
+                summary = plantDataB.groupby("ReportingFacilityID", sort=True, observed=True).agg(
+                    sumBalance=("sumBalance", "first"), status=("Unbalanced/Balanced", "first")).reset_index()
+                summary.insert(1, "ProductionMonth", date)
+                summaries.append(summary)
+                if includeRows:
+                    rows.append(plantDataB)
+        answer = {"facilities": facilityList, "months": dateList, "missingMonths": missing,
+                  "balances": records(summaries)}
+        if includeRows:
+            answer["rows"] = records(rows)
+        answer["milliseconds"] = round((time.perf_counter() - start) * 1000, 1)
+        return answer
+
+    def metrics(self):
+        return dict(self.cache.metrics(), queries=self.queries)
+
+
+def records(frames):
+    # frames as a list of json-ready dicts, to_json takes care of NaN and the NumPy types
+    if len(frames) == 0:
+        return []
+    return json.loads(pd.concat(frames, ignore_index=True).to_json(orient="records"))
+
+
+def queryMonths(query):
+    # the YYYY-MM start and end of a /balance query as a list of months
+    start = pd.Period(query["start"][0], freq="M")
+    end = pd.Period(query.get("end", query["start"])[0], freq="M")
+    return monthDates(start.month, start.year, end.month, end.year)
+
+
+def makeHandler(service):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            if url.path == "/metrics":
+                self.reply(200, service.metrics())
+            elif url.path == "/balance":
+                try:
+                    facilityList = list(dict.fromkeys(facilityID.strip().upper()
+                                                      for facilityID in ",".join(query["facilities"]).split(",")
+                                                      if facilityID.strip() != ""))
+                    dateList = queryMonths(query)
+                    if len(facilityList) == 0 or len(dateList) == 0:
+                        raise ValueError("no facilities or months")
+                except (KeyError, ValueError):
+                    self.reply(400, {"error": "use /balance?facilities=ID,ID&start=YYYY-MM&end=YYYY-MM"})
+                    return
+                self.reply(200, service.balance(facilityList, dateList, query.get("rows", ["0"])[0] == "1"))
+            else:
+                self.reply(404, {"error": f"{url.path} isn't here, use /balance or /metrics"})
+
+        def reply(self, status, body):
+            content = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+    return Handler
+
+
+def serve(service, port=servicePort):
+    server = ThreadingHTTPServer((serviceHost, port), makeHandler(service))
+    print(f"Balancing service listening on http://{serviceHost}:{port}, press Ctrl+C to stop\n")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,109 @@
+"""
+Balancing one month in facility shards across worker processes.
+
+A facility's balance only depends on its own rows, so a province-wide month can be split
+by facility and the pieces balanced side by side. writeShards gives every
+ReportingFacilityID a shard from a hash of the ID, which keeps all of a facility's rows
+together and puts a facility in the same shard on every run, and writes each shard as an
+Arrow file. The worker processes memory-map their shard and write their results back the
+same way, so the frames are never pickled between processes. The files go in /dev/shm
+where there is one, which keeps them in shared memory rather than on disk.
+
+Each row carries its row number in the month through the workers and mergeShards puts
+the shards' rows back in that order, so the merged result is the same frame a single
+process would have given, whatever the number of shards. The stages' printing is left
+to the parent, which prints the merged unbalanced plants instead of one list per shard.
+"""
+
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# the row number each row carries through the shards, dropped again when they are merged
+rowColumn = "shardRow"
+
+
+def shardFolder():
+    # a temporary folder for the shards in shared memory, the system's temporary folder without it
+    return tempfile.TemporaryDirectory(prefix="petrinexShards", dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+
+
+def facilityShards(facilityID, shards):
+    # each row's shard from a hash of its ReportingFacilityID, rows with no ID go in shard 0
+    facilityCodes, facilityIDs = pd.factorize(facilityID)
+    facilityShard = pd.util.hash_array(np.asarray(facilityIDs, dtype=object)) % np.uint64(shards)
+    return np.append(facilityShard.astype(np.intp), 0)[facilityCodes]
+
+
+def arrowColumns(plantData):
+    # read_csv can leave numbers and text in the same object column, and the 0 preprocessColumns fills
+    # blanks with does the same to text columns. Arrow needs one type per column so the numbers are
+    # written as text, the csv export writes them the same either way
+    mixed = {}
+    for column in plantData.columns:
+        values = plantData[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            # in compact mode it's the categories that are mixed
+            categories = values.cat.categories
+            if not isText(categories):
+                names = categories.astype(str)
+                mixed[column] = values.cat.rename_categories(names) if names.is_unique else values.astype(str).where(values.notna())
+        elif values.dtype == object and not isText(values):
+            mixed[column] = values.where(values.isna(), values.astype(str))
+    return plantData.assign(**mixed)
+
+
+def isText(values):
+    return pd.api.types.infer_dtype(values, skipna=True) in ("string", "empty")
+
+
+def writeShard(plantData, shardFile):
+    import pyarrow as pa
+
+    table = pa.Table.from_pandas(arrowColumns(plantData), preserve_index=False)
+    with pa.OSFile(shardFile, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    return shardFile
+
+
+def readShard(shardFile):
+    import pyarrow as pa
+
+    # the Arrow buffers are the memory-mapped file itself, nothing is read through a pipe
+    with pa.memory_map(shardFile) as source:
+        return pa.ipc.open_file(source).read_all().to_pandas()
+
+
+def writeShards(plantData, shards, folder):
+    # the month as shard files in folder, with each row's row number so the order can be put back
+    plantData = plantData.assign(**{rowColumn: np.arange(len(plantData))})
+    shard = facilityShards(plantData["ReportingFacilityID"], shards)
+    return [writeShard(plantData[shard == s], os.path.join(folder, f"shard{s}.arrow")) for s in range(shards)]
+
+
+def mergeShards(shardFiles):
+    # the shards' results in the order the rows were in the month
+    plantData = pd.concat([readShard(shardFile) for shardFile in shardFiles], ignore_index=True)
+    plantData = plantData.sort_values(rowColumn, kind="stable").drop(columns=rowColumn)
+    return plantData.reset_index(drop=True)
+
+
+def runShards(plantData, balanceShard, workers):
+    # balanceShard(shardFile) runs in a worker on each shard and returns the files it wrote, None
+    # for a result it skipped. returns the merged results in the same order, one shard per worker
+    with shardFolder() as folder:
+        shardFiles = writeShards(plantData, workers, folder)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(balanceShard, shardFiles))
+        return [None if files[0] is None else mergeShards(files) for files in zip(*results)]
+
+
+def reportUnbalanced(plantData):
+    # the merged shards' version of balanceData's list of unbalanced plants
+    plants = plantData.drop_duplicates("ReportingFacilityID")[["ReportingFacilityID", "sumBalance"]]
+    print("There are " + str(len(plants)) + " plants that have not been properly balanced:\n")
+    print(plants.sort_values(by=["sumBalance"]).reset_index(drop=True))
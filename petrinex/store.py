@@ -0,0 +1,77 @@
+"""
+Persistent per-month results for the over-time runs.
+
+Each month's balanced result is saved in the PetrinexResults folder under a key made
+from everything that can change it: the size and modified time of the month's
+Vol_YYYY-MM-AB.CSV, a hash of activityCodeFactors.csv, the exclusion rules and the
+facilities asked for. A rerun loads the months whose key hasn't changed and only
+balances the months that are new or whose inputs changed.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+
+# folder (in the working folder) the stored month results are kept in
+storeFolder = "PetrinexResults"
+
+
+def fileHash(path):
+    # sha256 of the file contents, used for the small config files
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def fileFingerprint(path):
+    # size and modified time, cheap to check for the large monthly files
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class ResultStore:
+    
+    def __init__(self, name, activityCodesCSV, exclusionRules, facilityList, folder=storeFolder):
+        # the parts of the key that are the same for every month of the run
+        self.name = name
+        self.folder = folder
+        self.runKey = {
+            "activityCodes": fileHash(activityCodesCSV),
+            "exclusionRules": sorted(map(list, zip(exclusionRules["ActivityID"], exclusionRules["ProductID"]))),
+            "facilities": sorted(facilityList),
+        }
+        # each run key gets its own files so different facility lists don't overwrite each other
+        self.runHash = hashlib.sha256(json.dumps(self.runKey, sort_keys=True).encode()).hexdigest()[:16]
+        os.makedirs(folder, exist_ok=True)
+    
+    def monthKey(self, DataCSV):
+        key = dict(self.runKey, data=fileFingerprint(DataCSV))
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+    
+    def path(self, date):
+        return os.path.join(self.folder, f"{self.name}_{self.runHash}_{date}.pkl")
+    
+    def isCurrent(self, date, DataCSV):
+        # True if the month is stored with a matching key, only the key at the front of the file is read
+        path = self.path(date)
+        if not os.path.exists(path) or not os.path.exists(DataCSV):
+            return False
+        with open(path, "rb") as f:
+            key = pickle.load(f)
+        return key == self.monthKey(DataCSV)
+    
+    def load(self, date):
+        with open(self.path(date), "rb") as f:
+            pickle.load(f)
+            return pickle.load(f)
+    
+    def save(self, date, DataCSV, result):
+        # the result can be None for months with no data for the facilities, that is stored too
+        path = self.path(date)
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump(self.monthKey(DataCSV), f)
+            pickle.dump(result, f)
+        os.replace(path + ".tmp", path)
@@ -0,0 +1,196 @@
+"""
+Seeded synthetic Petrinex volumetric data.
+
+generateMonth builds a month with the same columns as a Vol_YYYY-MM-AB.CSV download so the
+scripts and the benchmarks can run without the real files. Each facility's products are
+balanced by construction (what comes in is disposed of, flared, used as fuel etc.) and
+then a few things are mixed in the way they show up in the real data:
+- volumes over 1,000 are written with thousands separators and some are masked as ***
+- some volumes are blank and some rows are SAND, which doesn't balance
+- some facilities report extra FLARE ENTGAS, unbalanced until the exclusion rules take it out
+- some facilities are left unbalanced on purpose
+The same seed always gives the same file. writeMonth writes months of more than
+blockFacilities facilities a block of facilities at a time, so a month many times the
+size of a provincial one never has to fit in memory at once.
+"""
+
+import numpy as np
+import pandas as pd
+
+# the columns of the monthly volumetric files, in file order
+volumetricColumns = ['ProductionMonth', 'OperatorBAID', 'OperatorName', 'ReportingFacilityID',
+                     'ReportingFacilityProvinceState', 'ReportingFacilityType', 'ReportingFacilityIdentifier',
+                     'ReportingFacilityName', 'ReportingFacilitySubType', 'ReportingFacilitySubTypeDesc',
+                     'ReportingFacilityLocation', 'FacilityLegalSubdivision', 'FacilitySection',
+                     'FacilityTownship', 'FacilityRange', 'FacilityMeridian', 'SubmissionDate',
+                     'ActivityID', 'ProductID', 'FromToID', 'FromToIDProvinceState', 'FromToIDType',
+                     'FromToIDIdentifier', 'Volume', 'Energy', 'Hours', 'CCICode', 'ProrationProduct',
+                     'ProrationFactor', 'Heat']
+
+# activity codes and the factor each one balances with, written out as activityCodeFactors.csv
+activityFactors = {'PROD': 1, 'REC': 1, 'IMP': 1, 'INVOP': 1,
+                   'DISP': -1, 'FUEL': -1, 'FLARE': -1, 'VENT': -1, 'INJ': -1, 'SHR': -1, 'INVCL': -1}
+inflowActivities = ['PROD', 'REC', 'IMP', 'INVOP']
+outflowActivities = ['DISP', 'FUEL', 'FLARE', 'VENT', 'INJ', 'SHR', 'INVCL']
+
+# facility types with roughly how often they show up, and the products they report
+facilityTypes = {'BT': 0.45, 'GP': 0.15, 'GS': 0.15, 'IF': 0.10, 'WP': 0.10, 'TM': 0.05}
+subTypes = {'BT': ('311', 'CRUDE OIL SINGLE-WELL BATTERY'), 'GP': ('401', 'GAS PLANT SWEET'),
+            'GS': ('621', 'GAS GATHERING SYSTEM'), 'IF': ('503', 'INJECTION FACILITY'),
+            'WP': ('611', 'WATER DISPOSAL'), 'TM': ('671', 'TERMINAL')}
+products = ['GAS', 'OIL', 'WATER', 'COND', 'ENTGAS', 'C3-MX', 'C4-MX', 'C5-SP', 'LITEMX', 'BRKWTR']
+productWeights = [0.30, 0.20, 0.22, 0.08, 0.06, 0.03, 0.03, 0.03, 0.03, 0.02]
+
+# how much of the data is messy
+maskedShare = 0.01
+blankShare = 0.01
+sandShare = 0.02
+entgasFlareShare = 0.05
+unbalancedShare = 0.05
+
+# facilities generated at a time by writeMonth, 100,000 is about a provincial month (~1M rows)
+blockFacilities = 100_000
+
+
+def activityCodeTable():
+    return pd.DataFrame({'ActivityID': list(activityFactors), 'Factor': list(activityFactors.values())})
+
+
+def splitTotals(rng, group, totals, groupCount):
+    # split each group's total over its rows, the last row takes whatever is left
+    # after rounding so every group still adds up to its total
+    weights = rng.random(len(group)) + 0.1
+    share = weights / np.bincount(group, weights=weights, minlength=groupCount)[group]
+    amounts = np.round(totals[group] * share, 1)
+    last = np.r_[group[1:] != group[:-1], True]
+    amounts[last] = 0
+    amounts[last] = np.round(totals - np.bincount(group, weights=amounts, minlength=groupCount), 1)[group[last]]
+    return amounts
+
+
+def formatVolumes(volume):
+    # volumes of 1,000 or more get thousands separators like the Petrinex downloads
+    return np.array([f"{v:,.1f}" for v in volume], dtype=object)
+
+
+def generateMonth(facilities=1000, month="2022-12", seed=0, firstFacility=0):
+    # firstFacility numbers the facilities on from an earlier block of the same month
+    rng = np.random.default_rng(seed)
+
+    # facilities, their type and how many products each one reports
+    typeNames = list(facilityTypes)
+    facilityType = rng.choice(typeNames, size=facilities, p=list(facilityTypes.values()))
+    productCount = rng.integers(1, 5, size=facilities)
+    groupFacility = np.repeat(np.arange(facilities), productCount)
+    groupCount = len(groupFacility)
+    groupProduct = rng.choice(products, size=groupCount, p=productWeights)
+
+    # inflow rows for each facility and product, then the same total split over the outflow rows
+    inCount = rng.integers(1, 4, size=groupCount)
+    outCount = rng.integers(1, 4, size=groupCount)
+    inGroup = np.repeat(np.arange(groupCount), inCount)
+    outGroup = np.repeat(np.arange(groupCount), outCount)
+    inVolume = np.round(rng.gamma(1.2, 1500, size=len(inGroup)) + 0.1, 1)
+    totals = np.bincount(inGroup, weights=inVolume, minlength=groupCount)
+    outVolume = splitTotals(rng, outGroup, totals, groupCount)
+
+    rows = [
+        pd.DataFrame({'facility': groupFacility[inGroup], 'ActivityID': rng.choice(inflowActivities, size=len(inGroup)),
+                      'ProductID': groupProduct[inGroup], 'value': inVolume}),
+        pd.DataFrame({'facility': groupFacility[outGroup], 'ActivityID': rng.choice(outflowActivities, size=len(outGroup)),
+                      'ProductID': groupProduct[outGroup], 'value': outVolume}),
+    ]
+    balancedRows = len(inGroup) + len(outGroup)
+
+    def extraRows(share, activity, product, value, perRow=True):
+        count = max(1, int(round(share * (balancedRows if perRow else facilities))))
+        facility = rng.choice(facilities, size=count, replace=perRow or count > facilities)
+        return pd.DataFrame({'facility': facility,
+                             'ActivityID': activity if isinstance(activity, str) else rng.choice(activity, size=count),
+                             'ProductID': product if isinstance(product, str) else rng.choice(product, size=count),
+                             'value': value(count)})
+
+    # extra FLARE ENTGAS (unbalanced until the exclusion rules drop it), sand, deliberately
+    # unbalanced facilities, and masked or blank volumes
+    rows.append(extraRows(entgasFlareShare, 'FLARE', 'ENTGAS', lambda n: np.round(rng.gamma(1.5, 40, size=n) + 0.1, 1), perRow=False))
+    rows.append(extraRows(sandShare, inflowActivities + outflowActivities, 'SAND', lambda n: np.round(rng.gamma(1.5, 20, size=n) + 0.1, 1)))
+    rows.append(extraRows(unbalancedShare, inflowActivities, products, lambda n: np.round(rng.gamma(1.2, 300, size=n) + 1, 1), perRow=False))
+    rows.append(extraRows(maskedShare, outflowActivities, products, lambda n: np.full(n, np.nan)))
+    rows.append(extraRows(blankShare, outflowActivities, products, lambda n: np.full(n, -1.0)))
+
+    # petrinex files are ordered by facility
+    data = pd.concat(rows, ignore_index=True)
+    data = data.iloc[np.argsort(data['facility'].to_numpy(), kind='stable')].reset_index(drop=True)
+    facility = data['facility'].to_numpy()
+    n = len(data)
+
+    # masked volumes (NaN above) are written as ***, blank ones (-1 above) are left empty
+    value = data['value'].to_numpy()
+    volume = np.full(n, '', dtype=object)
+    numbered = value >= 0
+    volume[numbered] = formatVolumes(value[numbered])
+    volume[np.isnan(value)] = '***'
+
+    # descriptive columns are worked out per facility and then repeated for its rows
+    number = np.arange(firstFacility, firstFacility + facilities)
+    facilityNumber = np.char.zfill((number + 10000).astype(str), 7)
+    facilityID = np.char.add(np.char.add('AB', facilityType.astype(str)), facilityNumber)
+    operator = (number % max(1, facilities // 12) + 100).astype(str)
+    lsd = number % 16 + 1
+    section = number % 36 + 1
+    township = number % 126 + 1
+    rangeNumber = number % 30 + 1
+    meridian = number % 3 + 4
+    location = np.array([f"{a:02d}-{b:02d}-{c:03d}-{d:02d}W{e}" for a, b, c, d, e in zip(lsd, section, township, rangeNumber, meridian)])
+    subType = np.array([subTypes[t][0] for t in facilityType])
+    subTypeDesc = np.array([subTypes[t][1] for t in facilityType])
+    isGas = np.isin(data['ProductID'].to_numpy(), ['GAS', 'ENTGAS'])
+
+    monthData = pd.DataFrame({
+        'ProductionMonth': month,
+        'OperatorBAID': np.char.add('A', operator)[facility],
+        'OperatorName': np.char.add('OPERATOR ', operator)[facility],
+        'ReportingFacilityID': facilityID[facility],
+        'ReportingFacilityProvinceState': 'AB',
+        'ReportingFacilityType': facilityType[facility],
+        'ReportingFacilityIdentifier': facilityNumber[facility],
+        'ReportingFacilityName': np.char.add('FACILITY ', facilityNumber)[facility],
+        'ReportingFacilitySubType': subType[facility],
+        'ReportingFacilitySubTypeDesc': subTypeDesc[facility],
+        'ReportingFacilityLocation': location[facility],
+        'FacilityLegalSubdivision': lsd[facility],
+        'FacilitySection': section[facility],
+        'FacilityTownship': township[facility],
+        'FacilityRange': rangeNumber[facility],
+        'FacilityMeridian': np.char.add('W', meridian.astype(str))[facility],
+        'SubmissionDate': '2023-01-15',
+        'ActivityID': data['ActivityID'].to_numpy(),
+        'ProductID': data['ProductID'].to_numpy(),
+        'FromToID': np.where(data['ActivityID'].isin(['REC', 'DISP']).to_numpy(), np.char.add('ABBT', facilityNumber)[facility], ''),
+        'FromToIDProvinceState': '',
+        'FromToIDType': '',
+        'FromToIDIdentifier': '',
+        'Volume': volume,
+        'Energy': np.where(isGas & numbered, np.round(np.nan_to_num(value) * 38.5, 1).astype(str), ''),
+        'Hours': '',
+        'CCICode': '',
+        'ProrationProduct': '',
+        'ProrationFactor': '',
+        'Heat': np.where(isGas, '38.5', ''),
+    })
+    return monthData[volumetricColumns]
+
+
+def writeMonth(path, facilities=1000, month="2022-12", seed=0):
+    # write a synthetic month to csv, returns the number of rows written. the first block is
+    # generated from seed itself so a month that fits in one block is the same as it always was
+    rows = 0
+    for block, first in enumerate(range(0, facilities, blockFacilities)):
+        data = generateMonth(min(blockFacilities, facilities - first), month, seed if block == 0 else (seed, block), first)
+        data.to_csv(path, index=False, mode="w" if block == 0 else "a", header=block == 0)
+        rows += len(data)
+    return rows
+
+
+def writeActivityCodes(path):
+    activityCodeTable().to_csv(path, index=False)
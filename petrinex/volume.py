@@ -0,0 +1,47 @@
+"""
+Volume parsing for the monthly volumetric files.
+
+Petrinex writes volumes as text with thousands separators ("1,234.5"), masks some of
+them as "***" and leaves others blank. parseVolume turns the column into float64 in one
+go when the data is read, masked and blank volumes become 0 the same as the old
+astype(str) / replace / fillna / to_numeric chain in preprocessColumns.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def parseVolume(volume):
+    # returns the volumes as a float64 array plus the number of masked and unparseable values
+    if pd.api.types.is_numeric_dtype(volume):
+        values = volume.to_numpy(dtype="float64", copy=True)
+        values[np.isnan(values)] = 0
+        return values, 0, 0
+    
+    # a column read in chunks can hold both numbers and text, make it all text (blanks stay NaN)
+    if pd.api.types.infer_dtype(volume, skipna=True) != "string":
+        volume = volume.where(volume.isna(), volume.astype(str))
+    
+    # drop the thousands separators and parse everything in one go,
+    # only the values that fail (***, blanks, junk) need any more work
+    values = pd.to_numeric(volume.str.replace(",", "", regex=False), errors="coerce").to_numpy(dtype="float64", copy=True)
+    failed = np.flatnonzero(np.isnan(values))
+    text = volume.iloc[failed].fillna("")
+    blank = (text.str.strip() == "").to_numpy()
+    masked = text.str.contains("***", regex=False).to_numpy()
+    
+    # *** is read as 0, anything else that still can't be parsed is counted and set to 0
+    text = text.str.replace(",", "", regex=False).str.replace("***", "0", regex=False)
+    reparsed = pd.to_numeric(text, errors="coerce").to_numpy(dtype="float64")
+    unparseable = np.isnan(reparsed) & ~blank
+    reparsed[blank | unparseable] = 0
+    values[failed] = reparsed
+    return values, int(masked.sum()), int(unparseable.sum())
+
+
+def reportVolume(masked, unparseable):
+    # print a count of the volumes that were set to 0
+    if masked > 0:
+        print(f"{masked} masked (***) volumes were set to 0\n")
+    if unparseable > 0:
+        print(f"{unparseable} volumes could not be read as numbers and were set to 0\n")